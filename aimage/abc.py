@@ -1,12 +1,25 @@
+import asyncio
 from abc import ABC
-from typing import Union
+from typing import Dict, List, Optional, Tuple, Union
 
 import discord
-from aiohttp import ClientSession
 from redbot.core import Config, commands
 from redbot.core.bot import Red
 
 from aimage.apis.base_api import BaseAPI
+from aimage.apis.client import ClientRegistry
+from aimage.apis.response import ProgressEvent
+from aimage.common.autocomplete_store import AutocompleteStore
+from aimage.common.blacklist import BlacklistMatcher, RegexWorker
+from aimage.common.blob_store import BlobStore
+from aimage.common.endpoint_health import EndpointHealth
+from aimage.common.guild_settings import GuildSettings
+from aimage.common.job_store import JobStore
+from aimage.common.loop_lag import LoopLagMonitor
+from aimage.common.progress import EditScheduler
+from aimage.common.queue import EndpointQueue, QueuedJob
+from aimage.common.result_cache import ResultCache
+from aimage.common.search_index import SearchIndex
 
 
 class CompositeMetaClass(type(commands.Cog), type(ABC)):
@@ -16,9 +29,22 @@ class CompositeMetaClass(type(commands.Cog), type(ABC)):
 class MixinMeta(ABC):
     bot: Red
     config: Config
-    session: ClientSession
+    api_clients: ClientRegistry
     generating: dict
-    autocomplete_cache: dict
+    autocomplete_cache: AutocompleteStore
+    search_indexes: Dict[Tuple[str, str], SearchIndex]
+    queues: Dict[str, EndpointQueue]
+    status_task: Optional[asyncio.Task]
+    job_store: JobStore
+    result_cache: ResultCache
+    blob_store: BlobStore
+    endpoint_health: Dict[str, EndpointHealth]
+    probe_task: Optional[asyncio.Task]
+    status_edits: EditScheduler
+    loop_lag: LoopLagMonitor
+    guild_settings: Dict[int, GuildSettings]
+    blacklists: Dict[int, BlacklistMatcher]
+    regex_worker: RegexWorker
 
     def __init__(self, *args):
         pass
@@ -26,7 +52,58 @@ class MixinMeta(ABC):
     async def generate_image(self, *args, **kwargs):
         raise NotImplementedError
 
-    async def get_api_instance(self, ctx: Union[commands.Context, discord.Interaction]) -> BaseAPI:
+    async def check_queue_limits(self, guild: discord.Guild, user: discord.Member) -> Optional[str]:
+        raise NotImplementedError
+
+    async def get_endpoints(self, guild: discord.Guild) -> Dict[str, float]:
+        raise NotImplementedError
+
+    async def update_endpoints(self, guild: discord.Guild):
+        raise NotImplementedError
+
+    async def pick_endpoint(self, guild: discord.Guild, exclude: Optional[str] = None, key: Optional[str] = None) -> Optional[str]:
+        raise NotImplementedError
+
+    def record_endpoint_success(self, endpoint: str, latency: Optional[float] = None):
+        raise NotImplementedError
+
+    async def record_endpoint_failure(self, endpoint: str, error: BaseException):
+        raise NotImplementedError
+
+    def report_progress(self, job: QueuedJob, event: ProgressEvent):
+        raise NotImplementedError
+
+    async def queue_add(self, job: QueuedJob, persist: bool = True):
+        raise NotImplementedError
+
+    def find_jobs(self, guild_id: int, user_id: Optional[int] = None, parent_message_id: Optional[int] = None) -> List[QueuedJob]:
+        raise NotImplementedError
+
+    async def cancel_jobs(self, jobs: List[QueuedJob]) -> int:
+        raise NotImplementedError
+
+    async def _finish_job(self, job: QueuedJob):
+        raise NotImplementedError
+
+    async def _clear_job_status(self, job: QueuedJob):
+        raise NotImplementedError
+
+    async def _send_image_response(self, *args, **kwargs):
+        raise NotImplementedError
+
+    async def _execute_image_generation(self, *args, **kwargs):
+        raise NotImplementedError
+
+    async def _execute_batch_generation(self, jobs: List[QueuedJob]):
+        raise NotImplementedError
+
+    async def get_guild_settings(self, guild: discord.Guild) -> GuildSettings:
+        raise NotImplementedError
+
+    def invalidate_guild_settings(self, guild_id: int):
+        raise NotImplementedError
+
+    async def get_api_instance(self, ctx: Union[None, commands.Context, discord.Interaction] = None, guild: Optional[discord.Guild] = None, endpoint: Optional[str] = None) -> BaseAPI:
         raise NotImplementedError
 
     async def _update_autocomplete_cache(self, guild: discord.Guild):
@@ -1,28 +1,47 @@
-import re
+import time
+import random
 import logging
 import asyncio
 import aiohttp
 import discord
 from copy import copy
-from typing import Coroutine, List, Optional, Union
+from typing import Any, Coroutine, Dict, List, Mapping, Optional, Set, Tuple, Type, Union
 from collections import defaultdict
-from rapidfuzz import fuzz
 
 from redbot.core import Config, app_commands, checks, commands
 from redbot.core.bot import Red
+from redbot.core.data_manager import cog_data_path
 
 from aimage.abc import CompositeMetaClass
-from aimage.common.constants import DEFAULT_BADWORDS_BLACKLIST, DEFAULT_NEGATIVE_PROMPT, DEFAULT_TAGGER, DEFAULT_THRESHOLD
+from aimage.common import codec
+from aimage.common.autocomplete_store import AutocompleteStore
+from aimage.common.blacklist import BlacklistMatcher, RegexWorker
+from aimage.common.blob_store import BlobStore, blob_references
+from aimage.common.constants import AUTOCOMPLETE_CHECK_INTERVAL, AUTOCOMPLETE_CONCURRENCY, AUTOCOMPLETE_RETRY_INTERVAL, AUTOCOMPLETE_TTL, AUTOCOMPLETE_TTL_JITTER, \
+    BLOB_EXPIRY_INTERVAL, BLOB_MAX_AGE, DEFAULT_BADWORDS_BLACKLIST, DEFAULT_NEGATIVE_PROMPT, DEFAULT_TAGGER, DEFAULT_THRESHOLD, UNLOAD_DRAIN_TIMEOUT
+from aimage.common.endpoint_health import EndpointHealth
+from aimage.common.guild_settings import GuildSettings
 from aimage.common.helpers import send_response, clean_tag
+from aimage.common.job_store import JobStore
+from aimage.common.loop_lag import LoopLagMonitor
+from aimage.common.lora_index import LoraIndex
 from aimage.common.params import ImageGenParams
+from aimage.common.payload import Payload
+from aimage.common.progress import EditScheduler
+from aimage.common.queue import EndpointQueue, QueuedJob, estimate_cost, payload_key
+from aimage.common.result_cache import ResultCache
+from aimage.common.search_index import SearchIndex
 from aimage.image_handler import ImageHandler
-from aimage.apis.webui_api import WebuiAPI
+from aimage.queue_handler import QueueHandler
+from aimage.apis.client import ClientRegistry
+from aimage.apis.webui_api import A1111_SAMPLERS, WebuiAPI
 from aimage.settings import Settings
 
 log = logging.getLogger("red.bz_cogs.aimage")
 
 
 class AImage(Settings,
+             QueueHandler,
              ImageHandler,
              commands.Cog,
              metaclass=CompositeMetaClass):
@@ -33,8 +52,18 @@ class AImage(Settings,
         self.bot: Red = bot
         self.config = Config.get_conf(self, identifier=75567113)
 
-        self.queue: List[Coroutine] = []
-        self.queue_task: Optional[asyncio.Task] = None
+        self.queues: Dict[str, EndpointQueue] = {}
+        self.status_task: Optional[asyncio.Task] = None
+        self.job_store = JobStore(cog_data_path(self) / "queue.sqlite3")
+        self.result_cache = ResultCache(cog_data_path(self) / "results")
+        self.blob_store = BlobStore(cog_data_path(self) / "blobs")
+        self.endpoint_health: Dict[str, EndpointHealth] = {}
+        self.probe_task: Optional[asyncio.Task] = None
+        self.status_edits = EditScheduler()
+        self.loop_lag = LoopLagMonitor()
+        self.guild_settings: Dict[int, GuildSettings] = {}
+        self.blacklists: Dict[int, BlacklistMatcher] = {}
+        self.regex_worker = RegexWorker()
 
         default_guild = {
             "endpoint": None,
@@ -42,6 +71,7 @@ class AImage(Settings,
             "nsfw_tuning": -0.025,
             "words_blacklist": DEFAULT_BADWORDS_BLACKLIST,
             "blacklist_regex": "",
+            "blacklist_fail_open": False,
             "negative_prompt": DEFAULT_NEGATIVE_PROMPT,
             "cfg": 5,
             "sampling_steps": 24,
@@ -57,108 +87,169 @@ class AImage(Settings,
             "headers": "",
             "scheduler": "Automatic",
             "vip_role": -1,
+            "vip_weight": 2.0,
+            "followup_weight": 2.0,
+            "max_queue_guild": 20,
+            "max_queue_user": 3,
+            "queue_deadline": 0,
+            "endpoint_pool": {},
+        }
+
+        default_global = {
+            "endpoint_concurrency": {},
+            "endpoint_batch_size": {},
+            "max_queue": 100,
+            "affinity_delay": 30,
+            "result_cache_size": 256,
+            "resolve_seeds": False,
         }
 
         default_member = {
             "checkpoint": "",
         }
 
-        self.session = aiohttp.ClientSession()
+        self.api_clients = ClientRegistry()
         self.generating = defaultdict(lambda: False)
-        self.autocomplete_cache = defaultdict(dict)
-
+        self.autocomplete_cache = AutocompleteStore(cog_data_path(self) / "autocomplete.json", {"samplers": A1111_SAMPLERS})
+        self.search_indexes: Dict[Tuple[str, str], SearchIndex] = {}
+        self.autocomplete_task: Optional[asyncio.Task] = None
+        self.blob_task: Optional[asyncio.Task] = None
+        self.autocomplete_expiry: Dict[str, float] = {}
+        self.autocomplete_updates: Dict[str, asyncio.Task] = {}
+
+        self.config.register_global(**default_global)
         self.config.register_guild(**default_guild)
         self.config.register_member(**default_member)
 
     async def cog_load(self):
-        asyncio.create_task(self.load_all_autocomplete_caches())
+        self.loop_lag.start()
+        await self.result_cache.resize(await self.config.result_cache_size() * 1024**2)
+        # saved terms are served right away and count as stale, so they're fetched again in the background
+        self.autocomplete_cache.load()
+        for gid, data in (await self.config.all_guilds()).items():
+            self.autocomplete_cache.link(gid, data["endpoint"])
+        self.autocomplete_cache.forget_unused()
+        self.autocomplete_task = asyncio.create_task(self.refresh_autocomplete_caches())
+        self.blob_task = asyncio.create_task(self.expire_blobs())
+        asyncio.create_task(self.restore_queued_jobs())
 
     async def cog_unload(self):
-        await self.session.close()
+        if self.status_task:
+            self.status_task.cancel()
+        if self.probe_task:
+            self.probe_task.cancel()
+        if self.autocomplete_task:
+            self.autocomplete_task.cancel()
+        if self.blob_task:
+            self.blob_task.cancel()
+        self.loop_lag.stop()
+        # pending jobs stay saved and are restored the next time the cog loads
+        await asyncio.gather(*(queue.drain(UNLOAD_DRAIN_TIMEOUT) for queue in self.queues.values()))
+        await self.regex_worker.close()
+        await self.api_clients.close()
+        codec.shutdown()
+
+    async def red_delete_data_for_user(self, *, requester, user_id: int):
+        # uploaded images are shared by identical uploads, so the ones other users' jobs still need are kept
+        records = await self.job_store.all()
+        uploads = {reference for record in records if record["user_id"] == user_id for reference in blob_references(record["payload"])}
+        needed = {reference for record in records if record["user_id"] != user_id for reference in blob_references(record["payload"])}
+        await self.blob_store.remove(uploads - needed)
+        await self.job_store.remove_user(user_id)
+        for guild_id, members in (await self.config.all_members()).items():
+            if user_id in members:
+                await self.config.member_from_ids(guild_id, user_id).clear()
+                self.invalidate_guild_settings(guild_id)
+
+    async def saved_blob_references(self) -> Set[str]:
+        """ The images that saved jobs still need """
+        return {reference for record in await self.job_store.all() for reference in blob_references(record["payload"])}
+
+    async def expire_blobs(self):
+        """ Deletes uploaded images that weren't used in a while, unless a saved job still needs them """
+        while True:
+            try:
+                await self.blob_store.expire(BLOB_MAX_AGE, await self.saved_blob_references())
+            except Exception:  # noqa, reason: the loop must survive a failed cleanup
+                log.exception("Failed to delete expired images")
+            await asyncio.sleep(BLOB_EXPIRY_INTERVAL)
 
-    async def load_all_autocomplete_caches(self):
+    async def refresh_autocomplete_caches(self):
         await self.bot.wait_until_red_ready()
-        all_guilds = await self.config.all_guilds()
-        endpoint_to_cache = {}
-        for gid, data in all_guilds.items():
-            endpoint = data["endpoint"]
-            if not endpoint:
-                continue
-            if endpoint in endpoint_to_cache:
-                self.autocomplete_cache[gid] = endpoint_to_cache[endpoint]
-                log.info(f"Copied autocomplete cache from {endpoint} to guild {gid}")
-            else:
-                guild = self.bot.get_guild(gid)
-                if guild:
-                    await self._update_autocomplete_cache(guild)
-                    endpoint_to_cache[endpoint] = self.autocomplete_cache[gid]
-                    log.info(f"Created autocomplete cache for guild {gid} and endpoint {endpoint}")
-
-    # Some webuis can get overloaded with multiple requests, so we send one at a time
-    async def consume_queue(self):
-        while self.queue:
+        while True:
             try:
-                task = self.queue.pop(0)
-                await task
-            except Exception:  # noqa, reason: don't crash the task
-                log.exception("aimage task queue")
-            await asyncio.sleep(0.5)
-
-    def queue_add(self, task: Coroutine):
-        self.queue.append(task)
-        if not self.queue_task or self.queue_task.done():
-            self.queue_task = asyncio.create_task(self.consume_queue())
-
-    async def object_autocomplete(self, interaction: discord.Interaction, current: str, choices: list) -> List[app_commands.Choice[str]]:
-        if not choices:
-            #await self._update_autocomplete_cache(interaction)
+                await self.refresh_stale_autocomplete_caches()
+            except Exception:  # noqa, reason: the loop must survive anything a single refresh throws
+                log.exception("Failed to refresh autocomplete caches")
+            await asyncio.sleep(AUTOCOMPLETE_CHECK_INTERVAL)
+
+    async def refresh_stale_autocomplete_caches(self):
+        endpoint_guilds = {}
+        for gid, data in (await self.config.all_guilds()).items():
+            self.autocomplete_cache.link(gid, data["endpoint"])
+            if data["endpoint"] and data["endpoint"] not in endpoint_guilds and (guild := self.bot.get_guild(gid)):
+                endpoint_guilds[data["endpoint"]] = guild
+
+        # each endpoint is fetched once, through any guild that uses it
+        semaphore = asyncio.Semaphore(AUTOCOMPLETE_CONCURRENCY)
+
+        async def refresh(endpoint: str, guild: discord.Guild):
+            async with semaphore:
+                if task := await self.refresh_autocomplete_cache(guild):
+                    await task
+                    log.info(f"Updated autocomplete cache for endpoint {endpoint}")
+
+        await asyncio.gather(*(refresh(endpoint, guild) for endpoint, guild in endpoint_guilds.items()))
+
+    async def refresh_autocomplete_cache(self, guild: discord.Guild) -> Optional[asyncio.Task]:
+        """ Starts updating the autocomplete cache of the guild's endpoint if it's stale, meanwhile the stale one keeps being used """
+        endpoint = (await self.get_guild_settings(guild)).endpoint
+        if not endpoint:
+            return None
+        if endpoint in self.autocomplete_updates:
+            return self.autocomplete_updates[endpoint]
+        if time.monotonic() < self.autocomplete_expiry.get(endpoint, 0):
+            return None
+        task = self.autocomplete_updates[endpoint] = asyncio.create_task(self._update_autocomplete_cache(guild))
+        task.add_done_callback(lambda _: self.autocomplete_updates.pop(endpoint, None))
+        return task
+
+    def search_index(self, guild_id: int, key: str, index_type: Type[SearchIndex] = SearchIndex) -> SearchIndex:
+        options = self.autocomplete_cache[guild_id].get(key) or []
+        index_key = (self.autocomplete_cache.endpoint_of(guild_id) or "", key)
+        index = self.search_indexes.get(index_key)
+        # refreshing the cache replaces its lists, which also throws away the index and its remembered results
+        if index is None or index.source is not options:
+            index = self.search_indexes[index_key] = index_type(options)
+        return index
+
+    async def object_autocomplete(self, interaction: discord.Interaction, current: str, key: str) -> List[app_commands.Choice[str]]:
+        assert interaction.guild
+        await self.refresh_autocomplete_cache(interaction.guild)
+        index = self.search_index(interaction.guild.id, key)
+        if not index:
             return []
-        choices = self.filter_list(choices, current)
-        return [app_commands.Choice(name=choice, value=choice) for choice in choices[:25]]
+        return [app_commands.Choice(name=choice, value=choice) for choice in index.search(current)]
 
     async def samplers_autocomplete(self, interaction: discord.Interaction, current: str) -> List[app_commands.Choice[str]]:
-        choices = self.autocomplete_cache[interaction.guild_id].get("samplers") or []
-        return await self.object_autocomplete(interaction, current, choices)
+        return await self.object_autocomplete(interaction, current, "samplers")
 
     async def loras_autocomplete(self, interaction: discord.Interaction, current: str) -> List[app_commands.Choice[str]]:
-        choices = self.autocomplete_cache[interaction.guild_id].get("loras") or []
-
-        if not choices:
-            #await self._update_autocomplete_cache(interaction)
+        assert interaction.guild
+        await self.refresh_autocomplete_cache(interaction.guild)
+        cache = self.autocomplete_cache[interaction.guild.id]
+        index = self.search_index(interaction.guild.id, "lora_details" if "lora_details" in cache else "loras", LoraIndex)
+        if not index:
             return []
 
-        weight = "1"
-        previous = ""
-        if current:
-            if m := re.search(r"^((?:<[^>]+>\s*)+)([^<>]+)$", current): # multiple loras
-                current = m.group(2)
-                previous = m.group(1) + " "
-            if m := re.search(r"^([^:]+):([+-]?\d*\.?\d+)$", current): # lora weight
-                current = m.group(1)
-                weight = m.group(2)
-
-        choices = self.filter_list(choices, current, True)
-        choices = [f"{previous}<lora:{choice}:{weight}>" if len(f"{previous}<lora:{choice}:{weight}>") <= 100 else f"<lora:{choice}:{weight}>" for choice in choices]
-        return [app_commands.Choice(name=choice, value=choice) for choice in choices][:25]
+        assert isinstance(index, LoraIndex)
+        return [app_commands.Choice(name=choice, value=choice) for choice in index.complete(current)]
 
     async def checkpoint_autocomplete(self, interaction: discord.Interaction, current: str) -> List[app_commands.Choice[str]]:
-        choices = self.autocomplete_cache[interaction.guild_id].get("checkpoints") or []
-        return await self.object_autocomplete(interaction, current, choices)
+        return await self.object_autocomplete(interaction, current, "checkpoints")
 
     async def vae_autocomplete(self, interaction: discord.Interaction, current: str) -> List[app_commands.Choice[str]]:
-        choices = self.autocomplete_cache[interaction.guild_id].get("vaes") or []
-        return await self.object_autocomplete(interaction, current, choices)
-
-    @staticmethod
-    def filter_list(options: list, current: str, strict: bool = False):
-        results = []
-        ratios = [(item, fuzz.partial_ratio(current.lower(), item.lower())) for item in options]
-        sorted_options = sorted(ratios, key=lambda x: x[1], reverse=True)
-        for item, ratio in sorted_options:
-            if strict and ratio < 75:
-                continue
-            results.append(item)
-        return results
+        return await self.object_autocomplete(interaction, current, "vaes")
 
     _parameter_descriptions = {
         "prompt": "The prompt to generate an image from.",
@@ -284,7 +375,7 @@ class AImage(Settings,
 
         assert image.width and image.height
         size = image.width*image.height*scale*scale
-        maxsize = (await self.config.guild(ctx.guild).max_img2img())**2
+        maxsize = (await self.get_guild_settings(ctx.guild)).max_img2img**2
         if size > maxsize:
             return await interaction.followup.send(
                 f"Max img2img size is {int(maxsize**0.5)}² pixels. "
@@ -378,7 +469,7 @@ class AImage(Settings,
 
     async def generate_image(self,
                              context: Union[commands.Context, discord.Interaction],
-                             payload: dict = None,
+                             payload: Optional[Mapping[str, Any]] = None,
                              params: ImageGenParams = None,
                              callback: Optional[Coroutine] = None,
                              message_content: Optional[str] = None):
@@ -392,8 +483,9 @@ class AImage(Settings,
         user = context.user if isinstance(context, discord.Interaction) else context.author
         assert guild and isinstance(channel, discord.TextChannel) and isinstance(user, discord.Member)
 
-        vip_role = await self.config.guild(guild).vip_role()
-        if self.generating[user.id] and all(role.id != vip_role for role in user.roles):
+        settings = await self.get_guild_settings(guild)
+        is_vip = any(role.id == settings.vip_role for role in user.roles)
+        if self.generating[user.id] and not is_vip:
             content = ":warning: You must wait for your current image to finish generating before you can request a new one."
             return await send_response(context, content=content, ephemeral=True)
 
@@ -401,17 +493,71 @@ class AImage(Settings,
 
         if await self._contains_blacklisted_word(guild, prompt):
             return await send_response(context, content=":warning: Blocked prompt.")
-        
-        log.info(f"Queueing generation, {user.name=}")
-        self.queue_add(self._execute_image_generation(context, payload, params, callback, message_content))
+
+        # rerolls and variations from the image buttons arrive as a finished payload
+        is_followup = payload and not payload.get("enable_hr")
+
+        # a request over the limits is turned down before any work is done, unless its image may already be cached
+        reason = await self.check_queue_limits(guild, user)
+        seed = params.seed if params else payload.get("seed", -1)
+        if reason and seed in (-1, None):
+            return await send_response(context, content=reason, ephemeral=True)
+
+        if not payload:
+            api = await self.get_api_instance(context)
+            payload = await api._generate_payload(params)
+        payload = Payload.of(payload)
+
+        if await self.config.resolve_seeds():
+            # with a known seed the result can be cached
+            seeds = {}
+            if payload.get("seed", -1) == -1:
+                seeds["seed"] = random.randint(0, 2**32 - 1)
+            if payload.get("subseed_strength") and payload.get("subseed", -1) == -1:
+                seeds["subseed"] = random.randint(0, 2**32 - 1)
+            if seeds:
+                payload = payload.derive(seeds)
+
+        if cached := await self.result_cache.get(payload_key(payload), await self.get_endpoints(guild), payload):
+            log.info(f"Sending cached image, {user.name=}")
+            message_content = f"-# {message_content.strip()}" if message_content else None
+            return await self._send_image_response(context, cached, callback, message_content)
+
+        if reason:
+            return await send_response(context, content=reason, ephemeral=True)
+        if params and params.init_image:
+            # the payload only references its image, which is kept from here on
+            await self.blob_store.put(params.init_image, await self.saved_blob_references())
+        endpoint = await self.pick_endpoint(guild, key=payload_key(payload)) or ""
+
+        weight = settings.followup_weight if is_followup else 1.0
+        if is_vip:
+            weight *= settings.vip_weight
+
+        job = QueuedJob(
+            context=context,
+            payload=payload,
+            guild_id=guild.id,
+            user_id=user.id,
+            endpoint=endpoint,
+            callback=callback,
+            message_content=message_content,
+            cost=estimate_cost(payload),
+            weight=weight,
+        )
+        if settings.queue_deadline:
+            job.deadline = job.enqueued_at + settings.queue_deadline
+        if isinstance(context, discord.Interaction) and context.message:
+            job.parent_message_id = context.message.id
+        log.info(f"Queueing generation, {user.name=} endpoint={job.endpoint} cost={job.cost:.1f}")
+        await self.queue_add(job)
 
     async def _contains_blacklisted_word(self, guild: discord.Guild, prompt: str):
-        blacklist_regex = await self.config.guild(guild).blacklist_regex()
-        if blacklist_regex:
-            return re.search(blacklist_regex, prompt, re.IGNORECASE)
-        else:
-            blacklist = await self.config.guild(guild).words_blacklist()
-            return any(word in prompt.lower() for word in blacklist)
+        if guild.id not in self.blacklists:
+            settings = await self.get_guild_settings(guild)
+            self.blacklists[guild.id] = BlacklistMatcher(settings.words_blacklist, settings.blacklist_regex,
+                                                         self.regex_worker, settings.blacklist_fail_open)
+        return await self.blacklists[guild.id].search(prompt)
 
     async def _can_run_command(self, ctx: commands.Context, command_name: str) -> bool:
         prefix = await self.bot.get_prefix(ctx.message)
@@ -427,15 +573,33 @@ class AImage(Settings,
         return can
 
     async def _update_autocomplete_cache(self, guild: discord.Guild):
+        endpoint = (await self.get_guild_settings(guild)).endpoint
+        if not endpoint:
+            return
         api = await self.get_api_instance(guild=guild)
         try:
             log.debug(f"Ran a update to get possible autocomplete terms in server {guild.id}")
-            await api.update_autocomplete_cache(self.autocomplete_cache)
+            updated = await api.update_autocomplete_cache(self.autocomplete_cache.endpoint(endpoint))
         except NotImplementedError:
             log.debug(f"Autocomplete terms is not supported by the api in server {guild.id}")
-            pass
-
-    async def get_api_instance(self, ctx: Union[None, commands.Context, discord.Interaction] = None, guild: Union[None, discord.Guild] = None):
-        instance = WebuiAPI(self, context=ctx, guild=guild)
+            updated = True  # retrying sooner wouldn't change anything
+        jitter = random.uniform(1 - AUTOCOMPLETE_TTL_JITTER, 1 + AUTOCOMPLETE_TTL_JITTER)
+        self.autocomplete_expiry[endpoint] = time.monotonic() + (AUTOCOMPLETE_TTL * jitter if updated else AUTOCOMPLETE_RETRY_INTERVAL)
+        if updated:
+            await self.autocomplete_cache.save()
+
+    async def get_guild_settings(self, guild: discord.Guild) -> GuildSettings:
+        if guild.id not in self.guild_settings:
+            guild_data = await self.config.guild(guild).all()
+            members_data = await self.config.all_members(guild)
+            self.guild_settings[guild.id] = GuildSettings.from_config(guild_data, members_data)
+            self.autocomplete_cache.link(guild.id, guild_data["endpoint"])
+        return self.guild_settings[guild.id]
+
+    def invalidate_guild_settings(self, guild_id: int):
+        self.guild_settings.pop(guild_id, None)
+
+    async def get_api_instance(self, ctx: Union[None, commands.Context, discord.Interaction] = None, guild: Union[None, discord.Guild] = None, endpoint: Optional[str] = None):
+        instance = WebuiAPI(self, context=ctx, guild=guild, endpoint=endpoint)
         await instance._init()
         return instance
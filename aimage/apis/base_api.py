@@ -1,6 +1,7 @@
 from enum import Enum
-from typing import Optional
+from typing import Any, AsyncIterator, List, Mapping, Optional, Union
 
+from aimage.apis.response import ImageResponse, ProgressEvent
 from aimage.common.params import ImageGenParams
 
 
@@ -9,18 +10,38 @@ class ImageGenerationType(Enum):
     IMG2IMG = "img2img"
 
 
+class BatchUnsupported(Exception):
+    """ Raised when a webui rejects the per-image prompts and seeds of a batched request """
+
+
 class BaseAPI():
-    def __init__(self):
-        pass
+    endpoint: str
+
+    def __init__(self, endpoint: Optional[str] = None):
+        # the guild's main endpoint replaces an empty one once the api is initialized
+        self.endpoint = endpoint or ""
 
     async def _init(self):
         raise NotImplementedError
 
-    async def update_autocomplete_cache(self, cache: dict):
+    async def update_autocomplete_cache(self, cache: dict) -> bool:
+        raise NotImplementedError
+
+    async def generate_image(self, params: Optional[ImageGenParams] = None, payload: Optional[Mapping[str, Any]] = None):
         raise NotImplementedError
 
-    async def generate_image(self, params: Optional[ImageGenParams] = None, payload: Optional[dict] = None):
+    async def generate_image_stream(self, params: Optional[ImageGenParams] = None, payload: Optional[Mapping[str, Any]] = None) -> AsyncIterator[Union[ProgressEvent, ImageResponse]]:
+        """ Progress events while the image generates, followed by the finished image """
+        yield await self.generate_image(params, payload)
+
+    async def generate_batch(self, payloads: List[Mapping[str, Any]]):
         raise NotImplementedError
     
+    async def probe(self) -> float:
+        raise NotImplementedError
+
+    async def interrupt(self):
+        raise NotImplementedError
+
     async def force_close(self):
         raise NotImplementedError
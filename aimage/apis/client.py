@@ -0,0 +1,99 @@
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Collection, Dict, Optional, Tuple
+
+import aiohttp
+
+from aimage.common.constants import CLIENT_CONNECT_TIMEOUT, CLIENT_CONNECTION_LIMIT, CLIENT_DNS_CACHE_TTL, CLIENT_KEEPALIVE_TIMEOUT, \
+    PROGRESS_TIMEOUT
+from aimage.common.helpers import get_auth
+from aimage.common.progress import ProgressPoller
+
+log = logging.getLogger("red.bz_cogs.aimage")
+
+ClientKey = Tuple[str, str, str]
+
+
+def parse_headers(headers: str) -> Dict[str, str]:
+    parsed = {}
+    for header in headers.split("\n"):
+        header = header.strip()
+        if header.count(":") == 1:
+            key, val = header.split(":")
+            parsed[key.strip()] = val.strip()
+    return parsed
+
+
+class WebuiClient:
+    """
+    A long lived connection pool to a webui, logged in with a guild's auth and headers.
+    Once retired it's closed as soon as its last request finishes.
+    """
+
+    def __init__(self, endpoint: str, auth: Optional[str], headers: str):
+        self.endpoint = endpoint
+        connector = aiohttp.TCPConnector(limit_per_host=CLIENT_CONNECTION_LIMIT,
+                                         ttl_dns_cache=CLIENT_DNS_CACHE_TTL,
+                                         keepalive_timeout=CLIENT_KEEPALIVE_TIMEOUT)
+        self.session = aiohttp.ClientSession(connector=connector, auth=get_auth(auth or ""), headers=parse_headers(headers),
+                                             timeout=aiohttp.ClientTimeout(sock_connect=CLIENT_CONNECT_TIMEOUT))
+        # shared by every generation in this webui, whichever guild or api instance started it
+        self.progress = ProgressPoller(self._get_progress)
+        self.active = 0
+        self.retired = False
+
+    @asynccontextmanager
+    async def request(self, method: str, url: str, timeout: float, **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+        """ A request that gives up after `timeout` seconds without receiving data """
+        self.active += 1
+        try:
+            client_timeout = aiohttp.ClientTimeout(sock_connect=CLIENT_CONNECT_TIMEOUT, sock_read=timeout)
+            async with self.session.request(method, url, timeout=client_timeout, **kwargs) as response:
+                yield response
+        finally:
+            self.active -= 1
+            if self.retired and not self.active:
+                await self.session.close()
+
+    async def _get_progress(self) -> dict:
+        async with self.request("GET", self.endpoint + "progress", PROGRESS_TIMEOUT, raise_for_status=True) as response:
+            return await response.json()
+
+    async def retire(self):
+        self.retired = True
+        if not self.active:
+            await self.session.close()
+
+
+class ClientRegistry:
+    """ Webui clients shared by every request with the same endpoint, auth and headers """
+
+    def __init__(self):
+        self.clients: Dict[ClientKey, WebuiClient] = {}
+        self.guild_keys: Dict[Tuple[int, str], ClientKey] = {}
+
+    async def get(self, guild_id: int, endpoint: str, auth: Optional[str], headers: str) -> WebuiClient:
+        key = (endpoint, auth or "", headers)
+        if key not in self.clients:
+            self.clients[key] = WebuiClient(endpoint, auth, headers)
+            log.debug(f"Created a webui client for {endpoint}")
+        # a guild that changed its auth or headers leaves its old client behind
+        previous = self.guild_keys.get((guild_id, endpoint))
+        self.guild_keys[(guild_id, endpoint)] = key
+        if previous and previous != key and previous not in self.guild_keys.values():
+            await self.clients.pop(previous).retire()
+        return self.clients[key]
+
+    async def retire_guild(self, guild_id: int, endpoints: Collection[str]):
+        """ Lets go of a guild's clients for endpoints it stopped using, closing the ones no other guild uses """
+        for (gid, endpoint), key in list(self.guild_keys.items()):
+            if gid == guild_id and endpoint not in endpoints:
+                del self.guild_keys[(gid, endpoint)]
+                if key not in self.guild_keys.values():
+                    await self.clients.pop(key).retire()
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.session.close()
+        self.clients.clear()
+        self.guild_keys.clear()
@@ -1,12 +1,22 @@
 
 from dataclasses import dataclass, field
-from typing import Optional
+from typing import Any, Mapping, Optional
 
 
 @dataclass
 class ImageResponse:
     data: Optional[bytes] = None
-    payload: dict = field(default_factory=dict)
+    payload: Mapping[str, Any] = field(default_factory=dict)
     is_nsfw: bool = False
     info_string: str = ""
     extension: str = "png"
+    elapsed: float = 0.0
+
+
+@dataclass
+class ProgressEvent:
+    progress: float = 0.0
+    eta: float = 0.0
+    step: int = 0
+    steps: int = 0
+    preview: Optional[str] = None  # base64, straight from the webui
@@ -0,0 +1,209 @@
+import re
+import binascii
+from typing import AsyncIterable, Collection, Dict, List, Optional, Tuple
+
+WHITESPACE = b" \t\r\n"
+# characters that change the nesting of a json value, and the ones that end or escape a string
+STRUCTURE = re.compile(rb'["\[\]{},]')
+STRING_END = re.compile(rb'["\\]')
+
+
+class Base64Decoder:
+    """ Decodes base64 as it arrives, into a single growing buffer """
+
+    def __init__(self):
+        self.output = bytearray()
+        self.pending = b""
+
+    def feed(self, data: bytes):
+        data = self.pending + data
+        usable = len(data) - len(data) % 4
+        self.output += binascii.a2b_base64(data[:usable])
+        self.pending = data[usable:]
+
+    def finish(self) -> bytes:
+        if self.pending:
+            # unpadded leftovers
+            self.output += binascii.a2b_base64(self.pending + b"=" * (-len(self.pending) % 4))
+        return bytes(self.output)
+
+
+class GenerationResponseParser:
+    """
+    Incremental parser for the json body of the webui's txt2img and img2img responses.
+    The strings in `images` are base64 decoded as they arrive instead of being kept whole,
+    only the fields in `keep` are kept as raw json, and everything else is skipped over.
+    """
+
+    def __init__(self, max_images: int, keep: Collection[str] = ("info",)):
+        self.max_images = max_images
+        self.keep = keep
+        self.images: List[bytes] = []
+        self.fields: Dict[str, bytes] = {}
+        self.buffer = bytearray()
+        self.state = self._object_start
+        self.key = ""
+        self.decoder: Optional[Base64Decoder] = None
+        self.capture: Optional[bytearray] = None
+        self.depth = 0
+        self.in_string = False
+        self.done = False
+
+    def feed(self, chunk: bytes):
+        self.buffer += chunk
+        while not self.done and self.state():
+            pass
+
+    def result(self) -> Tuple[List[bytes], Dict[str, bytes]]:
+        if not self.done:
+            raise ValueError("Incomplete response from the webui")
+        return self.images, self.fields
+
+    # each state consumes what it can from the buffer, and returns whether it can continue without more data
+
+    def _next_char(self) -> Optional[int]:
+        i = 0
+        while i < len(self.buffer) and self.buffer[i] in WHITESPACE:
+            i += 1
+        del self.buffer[:i]
+        return self.buffer[0] if self.buffer else None
+
+    def _expect(self, char: bytes) -> bool:
+        found = self._next_char()
+        if found is None:
+            return False
+        if found != char[0]:
+            raise ValueError(f"Unexpected {chr(found)!r} in response from the webui, expected {char.decode()!r}")
+        del self.buffer[:1]
+        return True
+
+    def _object_start(self) -> bool:
+        if not self._expect(b"{"):
+            return False
+        self.state = self._key
+        return True
+
+    def _key(self) -> bool:
+        char = self._next_char()
+        if char is None:
+            return False
+        if char == ord(","):
+            del self.buffer[:1]
+            return True
+        if char == ord("}"):
+            del self.buffer[:1]
+            self.done = True
+            return False
+        end = self.buffer.find(b'"', 1)
+        if end == -1:
+            return False
+        self.key = self.buffer[1:end].decode()
+        del self.buffer[:end + 1]
+        self.state = self._colon
+        return True
+
+    def _colon(self) -> bool:
+        if not self._expect(b":"):
+            return False
+        if self.key == "images":
+            self.state = self._images_start
+        else:
+            self.capture = bytearray() if self.key in self.keep else None
+            self.depth = 0
+            self.in_string = False
+            self.state = self._skip_value
+        return True
+
+    def _images_start(self) -> bool:
+        if not self._expect(b"["):
+            return False
+        self.state = self._images
+        return True
+
+    def _images(self) -> bool:
+        char = self._next_char()
+        if char is None:
+            return False
+        del self.buffer[:1]
+        if char == ord("]"):
+            self.state = self._key
+        elif char == ord('"'):
+            self.decoder = Base64Decoder() if len(self.images) < self.max_images else None
+            self.state = self._image
+        elif char != ord(","):
+            raise ValueError(f"Unexpected {chr(char)!r} in the images of the webui's response")
+        return True
+
+    def _image(self) -> bool:
+        end = self.buffer.find(b'"')
+        data = bytes(self.buffer[:end]) if end != -1 else bytes(self.buffer)
+        if end == -1 and data.endswith(b"\\"):
+            # an escape split between chunks is finished with the next one
+            data = data[:-1]
+        del self.buffer[:len(data) + (end != -1)]
+        if self.decoder:
+            # json may escape the slashes of base64
+            self.decoder.feed(data.replace(b"\\/", b"/") if b"\\" in data else data)
+        if end == -1:
+            return False
+        if self.decoder:
+            self.images.append(self.decoder.finish())
+            self.decoder = None
+        self.state = self._images
+        return True
+
+    def _skip_value(self) -> bool:
+        # finds where the value ends without parsing it, jumping straight to the characters that matter
+        position = 0
+        if not self.in_string and self.depth == 0:
+            if self._next_char() is None:
+                return False
+        while True:
+            match = (STRING_END if self.in_string else STRUCTURE).search(self.buffer, position)
+            if not match:
+                self._consume(len(self.buffer))
+                return False
+            char = self.buffer[match.start()]
+            position = match.end()
+            if self.in_string:
+                if char == ord("\\"):
+                    if position >= len(self.buffer):
+                        self._consume(match.start())
+                        return False
+                    position += 1
+                    continue
+                self.in_string = False
+                if self.depth == 0:
+                    return self._value_end(position)
+            elif char == ord('"'):
+                self.in_string = True
+            elif char in b"[{":
+                self.depth += 1
+            elif self.depth == 0:
+                # a comma or bracket of the enclosing object ends a number, boolean or null
+                return self._value_end(match.start())
+            elif char in b"]}":
+                self.depth -= 1
+                if self.depth == 0:
+                    return self._value_end(position)
+
+    def _consume(self, length: int):
+        if self.capture is not None:
+            self.capture += self.buffer[:length]
+        del self.buffer[:length]
+
+    def _value_end(self, length: int) -> bool:
+        self._consume(length)
+        if self.capture is not None:
+            self.fields[self.key] = bytes(self.capture).strip()
+            self.capture = None
+        self.state = self._key
+        return True
+
+
+async def read_generation_response(chunks: AsyncIterable[bytes], max_images: int, keep: Collection[str] = ("info",)) -> Tuple[List[bytes], Dict[str, bytes]]:
+    """ The first `max_images` images of a webui generation response, and the raw json of the fields in `keep` """
+    parser = GenerationResponseParser(max_images, keep)
+    async for chunk in chunks:
+        parser.feed(chunk)
+    return parser.result()
@@ -1,23 +1,29 @@
-import json
-import base64
+import time
+import asyncio
+import random
 import logging
 from enum import Enum
-from typing import Any, Dict, Optional, Union
+from typing import Any, AsyncIterator, Dict, List, Mapping, Optional, Union
 
-import aiohttp
 import discord
 from redbot.core import commands
 from tenacity import retry, stop_after_attempt, wait_random
 
 from aimage.abc import MixinMeta
-from aimage.apis.base_api import BaseAPI
-from aimage.apis.response import ImageResponse
-from aimage.common.constants import ADETAILER_ARGS, EXCLUDE_TAGGER, TILED_VAE_ARGS
-from aimage.common.helpers import get_auth
+from aimage.apis.base_api import BaseAPI, BatchUnsupported
+from aimage.apis.response import ImageResponse, ProgressEvent
+from aimage.apis.response_stream import read_generation_response
+from aimage.apis.client import WebuiClient
+from aimage.common.constants import ADETAILER_ARGS, BATCH_LIST_FIELDS, ENDPOINT_PROBE_TIMEOUT, EXCLUDE_TAGGER, GENERATION_TIMEOUT, INTERROGATE_TIMEOUT, \
+    INTERRUPT_TIMEOUT, RESPONSE_CHUNK_SIZE, TERMS_TIMEOUT, TILED_VAE_ARGS
+from aimage.common import codec
+from aimage.common.lora_index import lora_details
 from aimage.common.params import ImageGenParams
 
 logger = logging.getLogger("red.bz_cogs.aimage")
 
+JSON_HEADERS = {"Content-Type": "application/json"}
+
 cache_mapping = {
     "upscalers": "upscalers",
     "scripts": "scripts",
@@ -54,66 +60,102 @@ A1111_SAMPLERS = [
 ]
 
 
+def _rejects_lists(detail: Any) -> bool:
+    """ Whether a validation error from the webui is about the fields a batch sends as lists """
+    if isinstance(detail, list):
+        fields = {str(part) for item in detail if isinstance(item, dict) for part in item.get("loc", [])}
+        return bool(fields & BATCH_LIST_FIELDS)
+    return any(field in str(detail) for field in BATCH_LIST_FIELDS)
+
+
 class ImageGenerationType(Enum):
     TXT2IMG = "txt2img"
     IMG2IMG = "img2img"
 
 
 class WebuiAPI(BaseAPI):
-    def __init__(self, cog: MixinMeta, context: Union[None, commands.Context, discord.Interaction], guild: Union[None, discord.Guild] = None):
-        self.session = cog.session
-        self.headers = {}
-        self.config = cog.config
+    def __init__(self, cog: MixinMeta, context: Union[None, commands.Context, discord.Interaction], guild: Union[None, discord.Guild] = None, endpoint: Optional[str] = None):
+        super().__init__(endpoint)
+        self.clients = cog.api_clients
+        self.blobs = cog.blob_store
+        self.endpoint_override = endpoint
+        self.get_guild_settings = cog.get_guild_settings
         self.context = context
         self.guild = context.guild if context else guild
         assert self.guild
-        cog.autocomplete_cache[self.guild.id]["samplers"] = A1111_SAMPLERS
 
     async def _init(self):
         assert self.guild
-        self.endpoint: str = await self.config.guild(self.guild).endpoint()
-        self.auth = get_auth(await self.config.guild(self.guild).auth())
-        raw_headers = await self.config.guild(self.guild).headers()
-        for header in raw_headers.split("\n"):
-            header = header.strip()
-            if header.count(":") == 1:
-                key, val = header.split(":")
-                self.headers[key.strip()] = val.strip()
-
-    async def update_autocomplete_cache(self, cache):
+        self.settings = await self.get_guild_settings(self.guild)
+        self.endpoint = self.endpoint_override or self.settings.endpoint or ""
+        self.client: WebuiClient = await self.clients.get(self.guild.id, self.endpoint, self.settings.auth, self.settings.headers)
+
+    async def update_autocomplete_cache(self, cache: dict) -> bool:
         assert self.guild
-        for page, cache_key in cache_mapping.items():
-            try:
-                data = await self._get_terms(page)
-            except Exception as e:
-                logger.warning(f"Failed to update autocomplete cache for {cache_key} in {self.guild.id}: \n {e}")
+        pages = list(cache_mapping.items())
+        results = await asyncio.gather(*(self._get_terms(page) for page, _ in pages), return_exceptions=True)
+        updated = False
+        for (page, cache_key), data in zip(pages, results):
+            if isinstance(data, Exception):
+                logger.warning(f"Failed to update autocomplete cache for {cache_key} in {self.guild.id}: \n {data}")
                 continue
+            updated = True
 
             if page == "scripts":
                 choices = [choice for choice in data["txt2img"]] if data else []
             elif page == "loras":
                 choices = [choice['name'] for choice in data] if data else []
+                self._set_cached(cache, "lora_details", [lora_details(choice) for choice in data] if data else [])
             elif page in ["sd-models", "sd-vae"]:
                 choices = [choice["model_name"] for choice in data] if data else []
             else:
                 choices = [choice["name"] for choice in data] if data else []
 
-            cache[self.guild.id][cache_key] = choices
+            self._set_cached(cache, cache_key, choices)
+        return updated
+
+    @staticmethod
+    def _set_cached(cache: dict, cache_key: str, choices: list):
+        # an unchanged list is kept as it is, so the search indexes built from it stay valid
+        if cache.get(cache_key) != choices:
+            cache[cache_key] = choices
 
-    async def generate_image(self, params: Optional[ImageGenParams] = None, payload: Optional[dict] = None):
+    async def generate_image(self, params: Optional[ImageGenParams] = None, payload: Optional[Mapping[str, Any]] = None):
         if params is None and payload is None:
             raise ValueError("Can't generate image with no payload and no params")
         payload = payload or await self._generate_payload(params)
         gen_type = ImageGenerationType.IMG2IMG if payload.get("init_images", []) else ImageGenerationType.TXT2IMG
         return await self._post_image_gen(payload, gen_type)
 
+    async def generate_image_stream(self, params: Optional[ImageGenParams] = None, payload: Optional[Mapping[str, Any]] = None) -> AsyncIterator[Union[ProgressEvent, ImageResponse]]:
+        poller = self.client.progress
+        subscription = poller.subscribe()
+        generation = asyncio.create_task(self.generate_image(params, payload))
+        progress: Optional[asyncio.Task] = None
+        try:
+            while not generation.done():
+                progress = asyncio.create_task(subscription.next())
+                await asyncio.wait({generation, progress}, return_when=asyncio.FIRST_COMPLETED)
+                if progress.done():
+                    yield progress.result()
+                else:
+                    progress.cancel()
+            yield generation.result()
+        finally:
+            poller.unsubscribe(subscription)
+            # also reached when the consumer is cancelled mid-wait, which must not leave either task behind
+            pending = [task for task in (generation, progress) if task and not task.done()]
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
     async def _generate_payload(self, params: Optional[ImageGenParams]) -> dict:
         assert self.guild and self.context
         if params is None:
             return {}
         if params.negative_prompt is None:
             params.negative_prompt = ""
-        stock_negative_prompt = await self.config.guild(self.guild).negative_prompt()
+        stock_negative_prompt = self.settings.negative_prompt
         if stock_negative_prompt not in params.negative_prompt:
             if params.negative_prompt:
                 params.negative_prompt = f"{stock_negative_prompt}, {params.negative_prompt}"
@@ -125,25 +167,25 @@ class WebuiAPI(BaseAPI):
 
         member = self.context.user if isinstance(self.context, discord.Interaction) else self.context.author
         assert isinstance(member, discord.Member)
-        checkpoint = params.checkpoint or await self.config.member(member).checkpoint() or await self.config.guild(self.guild).checkpoint() or ""
+        checkpoint = params.checkpoint or self.settings.member_checkpoints.get(member.id) or self.settings.checkpoint or ""
 
         payload: Dict[str, Any] = {
             "prompt": f"{params.prompt} {params.lora}",
             "negative_prompt": params.negative_prompt,
             "styles": params.style.split(", ") if params.style else [],
-            "cfg_scale": params.cfg or await self.config.guild(self.guild).cfg(),
-            "steps": params.steps or await self.config.guild(self.guild).sampling_steps(),
+            "cfg_scale": params.cfg or self.settings.cfg,
+            "steps": params.steps or self.settings.sampling_steps,
             "seed": params.seed,
             "subseed": params.subseed,
             "subseed_strength": params.subseed_strength,
-            "sampler_name": params.sampler or await self.config.guild(self.guild).sampler(),
-            "scheduler": params.scheduler or await self.config.guild(self.guild).scheduler(),
+            "sampler_name": params.sampler or self.settings.sampler,
+            "scheduler": params.scheduler or self.settings.scheduler,
             "override_settings": {
                 "sd_model_checkpoint": checkpoint,
-                "sd_vae": params.vae or await self.config.guild(self.guild).vae()
+                "sd_vae": params.vae or self.settings.vae
             },
-            "width": params.width or await self.config.guild(self.guild).width(),
-            "height": params.height or await self.config.guild(self.guild).height(),
+            "width": params.width or self.settings.width,
+            "height": params.height or self.settings.height,
             "alwayson_scripts": {}
         }
 
@@ -155,65 +197,108 @@ class WebuiAPI(BaseAPI):
 
         if params.init_image:
             payload.update({
-                "init_images": [base64.b64encode(params.init_image).decode("utf8")],
+                "init_images": [await self.blobs.reference(params.init_image)],
                 "denoising_strength": params.denoising
             })
 
-        if await self.config.guild(self.guild).adetailer():
+        if self.settings.adetailer:
             payload["alwayson_scripts"].update(ADETAILER_ARGS)
 
-        if await self.config.guild(self.guild).tiledvae():
+        if self.settings.tiledvae:
             payload["alwayson_scripts"].update(TILED_VAE_ARGS)
 
-        nsfw = await self.config.guild(self.guild).nsfw()
-        tuning = await self.config.guild(self.guild).nsfw_tuning()
         payload["script_name"] = "CensorScript"
-        payload["script_args"] = [True, not nsfw, tuning]
+        payload["script_args"] = [True, not self.settings.nsfw, self.settings.nsfw_tuning]
 
         return payload
 
+    async def generate_batch(self, payloads: List[Mapping[str, Any]]) -> List[ImageResponse]:
+        """ Generates compatible txt2img payloads in a single call, using per-image prompts and seeds """
+        seeds = [payload["seed"] if payload["seed"] != -1 else random.randint(0, 2**32 - 1) for payload in payloads]
+        batch_payload = {
+            **payloads[0],
+            "prompt": [payload["prompt"] for payload in payloads],
+            "negative_prompt": [payload["negative_prompt"] for payload in payloads],
+            "seed": seeds,
+            "batch_size": len(payloads),
+            "n_iter": 1,
+            "do_not_save_grid": True,
+        }
+        try:
+            return await self._post_image_batch(batch_payload, ImageGenerationType.TXT2IMG, payloads)
+        except ValueError as error:
+            # the webui validates the request before generating anything, lists where it expects a single value fail here
+            if _rejects_lists(error.args[0] if error.args else None):
+                raise BatchUnsupported(str(error)) from error
+            raise
+
     async def _post_image_gen(self, payload, generation_type: ImageGenerationType):
+        return (await self._post_image_batch(payload, generation_type, [payload]))[0]
+
+    async def _post_image_batch(self, payload, generation_type: ImageGenerationType, requested: List[Mapping[str, Any]]) -> List[ImageResponse]:
         url = self.endpoint + generation_type.value
-        async with self.session.post(url=url, json=payload, auth=self.auth, headers=self.headers) as response:
-            r = await response.json()
+        start = time.monotonic()
+        # payloads are only flattened and their images encoded as they're sent
+        body = await codec.encode_json(await self.blobs.resolve(dict(payload)))
+        async with self.client.request("POST", url, GENERATION_TIMEOUT, data=body, headers=JSON_HEADERS) as response:
             if response.status == 422:
-                raise ValueError(r["detail"])
+                raise ValueError((await response.json())["detail"])
             elif response.status != 200:
                 response.raise_for_status()
-            data = base64.b64decode(r["images"][0])
+            # the body is mostly base64 images, which are decoded as they arrive instead of after reading it all
+            keep = ("info", "parameters") if logger.isEnabledFor(logging.DEBUG) else ("info",)
+            images, fields = await read_generation_response(response.content.iter_chunked(RESPONSE_CHUNK_SIZE), len(requested), keep)
+            if len(images) < len(requested):
+                raise RuntimeError(f"Requested {len(requested)} images but the webui returned {len(images)}")
 
             # a1111 shenanigans
-            info = json.loads(r["info"])
-            info_string = info.get("infotexts")[0]
-            try:
-                is_nsfw = info.get("extra_generation_params", {}).get("nsfw", [])[0]
-            except IndexError:
-                is_nsfw = False
+            info = codec.loads(codec.loads(fields["info"]))
+            infotexts = info.get("infotexts")
+            nsfw = info.get("extra_generation_params", {}).get("nsfw", [])
 
             if logger.isEnabledFor(logging.DEBUG):
-                del r["images"]
-                logger.debug(f"Requested with parameters: {json.dumps(r, indent=4)}")
+                logger.debug(f"Requested with parameters: {fields.get('parameters', b'').decode()}")
 
-        return ImageResponse(data=data, info_string=info_string, is_nsfw=is_nsfw, payload=payload)
+        elapsed = time.monotonic() - start
+        return [ImageResponse(data=data,
+                              info_string=infotexts[i],
+                              is_nsfw=bool(nsfw[i]) if isinstance(nsfw, list) and i < len(nsfw) else False,
+                              payload=requested[i],
+                              elapsed=elapsed)
+                for i, data in enumerate(images)]
 
     @retry(wait=wait_random(min=3, max=5), stop=stop_after_attempt(1), reraise=True)
     async def _get_terms(self, page):
         url = self.endpoint + page
-        async with self.session.get(url=url, auth=self.auth, headers=self.headers, raise_for_status=True) as response:
+        async with self.client.request("GET", url, TERMS_TIMEOUT, raise_for_status=True) as response:
             return await response.json()
         
     async def interrogate(self, image: bytes, model: str, threshold: float):
         url = self.endpoint.replace("/sdapi/v1", "/tagger/v1") + "interrogate"
         payload = {
-            "image": base64.b64encode(image).decode("utf8"),
+            "image": await codec.b64encode(image),
             "model": model,
             "threshold": threshold,
         }
-        async with self.session.post(url=url, json=payload, auth=self.auth, headers=self.headers, raise_for_status=True) as response:
+        body = await codec.encode_json(payload)
+        async with self.client.request("POST", url, INTERROGATE_TIMEOUT, data=body, headers=JSON_HEADERS, raise_for_status=True) as response:
             response = await response.json()
             return [tag for tag in response.get("caption", {}).keys() if tag not in EXCLUDE_TAGGER]
     
+    async def probe(self) -> float:
+        """ Cheap request to check that the webui is responsive, returns how long it took """
+        url = self.endpoint + "progress?skip_current_image=true"
+        start = time.monotonic()
+        async with self.client.request("GET", url, ENDPOINT_PROBE_TIMEOUT, raise_for_status=True) as response:
+            await response.read()
+        return time.monotonic() - start
+
+    async def interrupt(self):
+        url = self.endpoint + "interrupt"
+        async with self.client.request("POST", url, INTERRUPT_TIMEOUT, raise_for_status=True) as response:
+            return response.status
+
     async def force_close(self):
         url = self.endpoint.replace("/sdapi/v1", "") + "force_close"
-        async with self.session.post(url=url, auth=self.auth, headers=self.headers, raise_for_status=True) as response:
+        async with self.client.request("POST", url, INTERRUPT_TIMEOUT, raise_for_status=True) as response:
             return response.status
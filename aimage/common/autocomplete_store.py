@@ -0,0 +1,83 @@
+import os
+import json
+import asyncio
+import logging
+from pathlib import Path
+from typing import Dict, Optional
+
+log = logging.getLogger("red.bz_cogs.aimage")
+
+
+class AutocompleteStore:
+    """
+    Autocomplete terms fetched once per endpoint.
+    Guilds are linked to the endpoint they use and read its terms, so guilds sharing an endpoint share one cache.
+    The terms are saved to `path`, so they're usable right after a restart while they get fetched again.
+    """
+
+    def __init__(self, path: Optional[Path] = None, defaults: Optional[dict] = None):
+        self.path = path
+        self.defaults = defaults or {}
+        self.endpoints: Dict[str, dict] = {}
+        self.guild_endpoints: Dict[int, str] = {}
+        self.lock = asyncio.Lock()
+
+    def __getitem__(self, guild_id: int) -> dict:
+        endpoint = self.guild_endpoints.get(guild_id)
+        return self.endpoints.get(endpoint, self.defaults) if endpoint else {}
+
+    def endpoint(self, endpoint: str) -> dict:
+        """ The terms of an endpoint, which updates write into """
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = dict(self.defaults)
+        return self.endpoints[endpoint]
+
+    def endpoint_of(self, guild_id: int) -> Optional[str]:
+        return self.guild_endpoints.get(guild_id)
+
+    def link(self, guild_id: int, endpoint: Optional[str]):
+        previous = self.guild_endpoints.get(guild_id)
+        endpoint = endpoint or None
+        if endpoint == previous:
+            return
+        if endpoint:
+            self.guild_endpoints[guild_id] = endpoint
+        else:
+            del self.guild_endpoints[guild_id]
+        # the terms of an endpoint nobody uses anymore are forgotten
+        if previous and previous not in self.guild_endpoints.values():
+            self.endpoints.pop(previous, None)
+
+    def forget_unused(self):
+        for endpoint in set(self.endpoints) - set(self.guild_endpoints.values()):
+            del self.endpoints[endpoint]
+
+    def load(self):
+        if not self.path or not self.path.exists():
+            return
+        try:
+            endpoints = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            log.warning("Failed to load the saved autocomplete cache", exc_info=True)
+            return
+        for endpoint, terms in endpoints.items():
+            self.endpoint(endpoint).update(terms)
+        log.info(f"Loaded saved autocomplete cache of {len(endpoints)} endpoints")
+
+    async def save(self):
+        if not self.path:
+            return
+        path = self.path
+        endpoints = {endpoint: dict(terms) for endpoint, terms in self.endpoints.items()}
+
+        def _write():
+            # written next to the old one and swapped in, so a crash can't leave half a file
+            temp = path.with_suffix(".tmp")
+            temp.write_text(json.dumps(endpoints))
+            os.replace(temp, path)
+
+        async with self.lock:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, _write)
+            except OSError:
+                log.warning("Failed to save the autocomplete cache", exc_info=True)
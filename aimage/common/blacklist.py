@@ -0,0 +1,218 @@
+import re
+import sys
+import json
+import asyncio
+import logging
+from typing import Dict, Iterable, List, Optional, Pattern, Set
+
+try:
+    from re import _parser as sre_parse  # type: ignore
+except ImportError:  # python < 3.11
+    import sre_parse  # type: ignore
+
+try:
+    import re2  # type: ignore
+except ImportError:
+    re2 = None
+
+from aimage.common.constants import BLACKLIST_REGEX_TIMEOUT
+
+log = logging.getLogger("red.bz_cogs.aimage")
+
+
+class BlacklistMatcher:
+    """
+    A guild's blacklist compiled once, either its custom regex or its word list.
+    Words are merged into a single regex shaped like a trie, so a prompt is scanned once
+    instead of once per word, and the regex engine never retries a shared prefix.
+    A custom regex runs in RE2 when it's installed, otherwise in the worker process with a time limit.
+    """
+
+    def __init__(self, words: Iterable[str], regex: str = "", worker: Optional["RegexWorker"] = None, fail_open: bool = False):
+        self.regex = regex
+        self.linear: Optional[Pattern] = compile_linear(regex) if regex else None
+        self.worker = worker
+        self.fail_open = fail_open
+        words = [word for word in words if isinstance(word, str)]
+        self.words: Optional[Pattern] = re.compile(trie_pattern(words)) if words else None
+
+    async def search(self, prompt: str) -> bool:
+        if self.regex:
+            return await self.search_regex(prompt)
+        return self.search_words(prompt)
+
+    def search_words(self, prompt: str) -> bool:
+        # words are matched as they were saved against the lowercased prompt, like a substring check
+        return bool(self.words and self.words.search(prompt.lower()))
+
+    async def search_regex(self, prompt: str) -> bool:
+        if self.linear:
+            return bool(self.linear.search(prompt))
+        assert self.worker
+        try:
+            return await self.worker.search(self.regex, prompt, BLACKLIST_REGEX_TIMEOUT)
+        except (asyncio.TimeoutError, re.error) as e:
+            log.warning(f"Blacklist regex failed on a prompt of length {len(prompt)}, {'allowing' if self.fail_open else 'rejecting'} it: {e!r}")
+            return not self.fail_open
+
+
+# reads one json line per search, so it's never slowed down by the bot and can be killed mid search
+WORKER_SOURCE = """
+import re, sys, json
+from functools import lru_cache
+compile = lru_cache(maxsize=32)(re.compile)
+for line in sys.stdin:
+    regex, text = json.loads(line)
+    try:
+        result = bool(compile(regex, re.IGNORECASE).search(text))
+    except re.error as e:
+        result = str(e)
+    sys.stdout.write(json.dumps(result) + "\\n")
+    sys.stdout.flush()
+"""
+
+
+class RegexWorker:
+    """ A python process that runs regex searches one at a time, restarted whenever a search runs out of time """
+
+    def __init__(self):
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.lock = asyncio.Lock()
+
+    async def search(self, regex: str, text: str, timeout: float) -> bool:
+        async with self.lock:
+            if self.process is None or self.process.returncode is not None:
+                self.process = await asyncio.create_subprocess_exec(
+                    sys.executable, "-I", "-c", WORKER_SOURCE,
+                    stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+            assert self.process.stdin and self.process.stdout
+            try:
+                self.process.stdin.write(json.dumps([regex, text]).encode() + b"\n")
+                await self.process.stdin.drain()
+                line = await asyncio.wait_for(self.process.stdout.readline(), timeout)
+            except (asyncio.TimeoutError, ConnectionError):
+                line = b""
+            if not line:
+                await self.close()
+                raise asyncio.TimeoutError
+        result = json.loads(line)
+        if isinstance(result, str):
+            raise re.error(result)
+        return result
+
+    async def close(self):
+        if self.process and self.process.returncode is None:
+            self.process.kill()
+            await self.process.wait()
+        self.process = None
+
+
+def compile_linear(regex: str) -> Optional[Pattern]:
+    """ Compiles the regex with RE2 if it's installed, which runs in linear time but lacks backreferences and lookarounds """
+    if re2 is None:
+        return None
+    try:
+        return re2.compile("(?i)" + regex)
+    except Exception:  # noqa, reason: each re2 binding has its own error type for unsupported syntax
+        return None
+
+
+def check_regex(regex: str) -> List[str]:
+    """ Reasons why a blacklist regex shouldn't be used, empty if it's fine """
+    try:
+        parsed = sre_parse.parse(regex, re.IGNORECASE)
+    except re.error as e:
+        return [f"Invalid regex: {e}"]
+    if compile_linear(regex):
+        return []
+    return list(dict.fromkeys(_backtracking_hazards(parsed, None)))
+
+
+def _backtracking_hazards(pattern, outer_unbounded: Optional[bool]) -> List[str]:
+    # outer_unbounded is None outside of repeats, otherwise whether the innermost repeat has no upper limit
+    hazards = []
+    for op, av in pattern:
+        if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            low, high, subpattern = av
+            unbounded = high == sre_parse.MAXREPEAT
+            if high != low and outer_unbounded is not None and (unbounded or outer_unbounded):
+                hazards.append("A repetition is nested inside another repetition, like `(a+)+`")
+            if unbounded and _ambiguous_branch(subpattern):
+                hazards.append("A repeated alternation has options that can match the same text, like `(a|ab)*`")
+            inner = outer_unbounded if high == low else unbounded or bool(outer_unbounded)
+            hazards += _backtracking_hazards(subpattern, inner)
+        elif op is sre_parse.SUBPATTERN:
+            hazards += _backtracking_hazards(av[-1], outer_unbounded)
+        elif op is sre_parse.BRANCH:
+            for branch in av[1]:
+                hazards += _backtracking_hazards(branch, outer_unbounded)
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            hazards += _backtracking_hazards(av[1], outer_unbounded)
+        elif op is sre_parse.GROUPREF_EXISTS:
+            for branch in av[1:]:
+                if branch:
+                    hazards += _backtracking_hazards(branch, outer_unbounded)
+        # atomic groups and possessive repeats never backtrack into themselves, so they're left alone
+    return hazards
+
+
+def _ambiguous_branch(pattern) -> bool:
+    for op, av in pattern:
+        if op is sre_parse.SUBPATTERN:
+            return _ambiguous_branch(av[-1])
+        if op is not sre_parse.BRANCH:
+            continue
+        seen: Set[int] = set()
+        for branch in av[1]:
+            if not branch:
+                return True
+            first = _first_chars(branch)
+            if first is None:
+                continue
+            if seen & first:
+                return True
+            seen |= first
+    return False
+
+
+def _first_chars(pattern) -> Optional[Set[int]]:
+    """ The lowercased characters a pattern can start with, or None if there are too many to tell """
+    op, av = pattern[0]
+    if op is sre_parse.SUBPATTERN:
+        return _first_chars(av[-1]) if av[-1] else None
+    if op is sre_parse.LITERAL:
+        return {ord(chr(av).lower())}
+    if op is sre_parse.IN:
+        chars = set()
+        for item_op, item in av:
+            if item_op is sre_parse.LITERAL:
+                chars.add(ord(chr(item).lower()))
+            elif item_op is sre_parse.RANGE and item[1] - item[0] <= 256:
+                chars.update(ord(chr(char).lower()) for char in range(item[0], item[1] + 1))
+            else:
+                return None
+        return chars
+    return None
+
+
+def trie_pattern(words: Iterable[str]) -> str:
+    """ A regex matching any of the words, with common prefixes factored out """
+    trie: Dict = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+    return _node_pattern(trie)
+
+
+def _node_pattern(node: Dict) -> str:
+    # the shortest match is enough to know a word is present, so nothing past the end of a word is needed
+    prefix = ""
+    while "" not in node and len(node) == 1:
+        char, node = next(iter(node.items()))
+        prefix += re.escape(char)
+    if "" in node:
+        return prefix
+    branches = [re.escape(char) + _node_pattern(child) for char, child in sorted(node.items())]
+    return prefix + (branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})")
@@ -0,0 +1,179 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Collection, Dict, Iterable, Mapping, Optional, Set
+
+from aimage.common import codec
+from aimage.common.constants import BLOB_DISK_BYTES, BLOB_MEMORY_BYTES
+
+log = logging.getLogger("red.bz_cogs.aimage")
+
+REFERENCE_PREFIX = "blob:"
+
+
+def is_reference(value: Any) -> bool:
+    return isinstance(value, str) and value.startswith(REFERENCE_PREFIX)
+
+
+def blob_references(payload: Mapping[str, Any]) -> Set[str]:
+    references = set()
+    for field in codec.BASE64_FIELDS:
+        value = payload.get(field)
+        for image in value if isinstance(value, list) else [value]:
+            if is_reference(image):
+                references.add(image)
+    return references
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class BlobStore:
+    """
+    Images stored once under their hash, so payloads can carry a short reference instead of the base64 image.
+    The most recently used are kept in memory and every image is written to disk, which outlives restarts
+    and is trimmed to `max_disk` bytes by deleting the least recently used.
+    Images are uploaded by users, so the ones that aren't needed anymore are deleted with `expire`.
+    """
+
+    def __init__(self, path: Path, max_memory: int = BLOB_MEMORY_BYTES, max_disk: int = BLOB_DISK_BYTES):
+        self.path = path
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self.memory_size = 0
+        self.disk: "OrderedDict[str, int]" = OrderedDict()
+        self.used: Dict[str, float] = {}
+        self.path.mkdir(parents=True, exist_ok=True)
+        for file in sorted(self.path.iterdir(), key=lambda file: file.stat().st_mtime):
+            if file.suffix == ".tmp":
+                file.unlink(missing_ok=True)
+            else:
+                self.disk[file.name] = file.stat().st_size
+                self.used[file.name] = file.stat().st_mtime
+
+    async def reference(self, data: bytes) -> str:
+        """ The reference an image gets once stored, without storing it """
+        return REFERENCE_PREFIX + await codec.offload(len(data), _digest, data)
+
+    async def put(self, data: bytes, keep: Collection[str] = ()) -> str:
+        """ Stores an image, returning its reference. Making room for it never deletes the references in `keep` """
+        key = (await self.reference(data))[len(REFERENCE_PREFIX):]
+        self._remember(key, data)
+        self.used[key] = time.time()
+        if key in self.disk:
+            self.disk.move_to_end(key)
+            await asyncio.get_running_loop().run_in_executor(None, self._touch, key)
+            return REFERENCE_PREFIX + key
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, key, data)
+        except OSError:
+            log.warning(f"Failed to save image {key}", exc_info=True)
+        else:
+            self.disk[key] = len(data)
+            await self._trim_disk(keep)
+        return REFERENCE_PREFIX + key
+
+    async def get(self, reference: str) -> Optional[bytes]:
+        key = reference[len(REFERENCE_PREFIX):]
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.used[key] = time.time()
+            return self.memory[key]
+        if key not in self.disk:
+            return None
+        try:
+            data = await asyncio.get_running_loop().run_in_executor(None, self._read, key)
+        except OSError:
+            log.warning(f"Failed to read image {key}", exc_info=True)
+            self.disk.pop(key, None)
+            return None
+        self.disk.move_to_end(key)
+        self._remember(key, data)
+        self.used[key] = time.time()
+        return data
+
+    async def expire(self, max_age: float, keep: Collection[str] = ()):
+        """ Deletes the images unused for `max_age` seconds, except for the references in `keep` """
+        cutoff = time.time() - max_age
+        expired = [REFERENCE_PREFIX + key for key, used in self.used.items() if used < cutoff]
+        await self.remove(reference for reference in expired if reference not in keep)
+
+    async def remove(self, references: Iterable[str]):
+        for reference in references:
+            key = reference[len(REFERENCE_PREFIX):]
+            self.used.pop(key, None)
+            if key in self.memory:
+                self.memory_size -= len(self.memory.pop(key))
+            if self.disk.pop(key, None) is not None:
+                await asyncio.get_running_loop().run_in_executor(None, self._delete, key)
+
+    async def resolve(self, payload: dict) -> dict:
+        """ A copy of the payload with its image references replaced by base64, as the webui expects """
+        resolved = {}
+        for field in codec.BASE64_FIELDS:
+            value = payload.get(field)
+            if is_reference(value):
+                resolved[field] = await self._encode(value)
+            elif isinstance(value, list) and any(is_reference(image) for image in value):
+                resolved[field] = [await self._encode(image) if is_reference(image) else image for image in value]
+        return {**payload, **resolved} if resolved else payload
+
+    async def _encode(self, reference: str) -> str:
+        data = await self.get(reference)
+        if data is None:
+            raise ValueError("The image for this request is no longer available, please upload it again")
+        return await codec.b64encode(data)
+
+    def _remember(self, key: str, data: bytes):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return
+        if len(data) > self.max_memory:
+            return
+        self.memory[key] = data
+        self.memory_size += len(data)
+        while self.memory_size > self.max_memory:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_size -= len(evicted)
+
+    async def _trim_disk(self, keep: Collection[str] = ()):
+        size = sum(self.disk.values())
+        # the newest image is the one that was just stored
+        for key in list(self.disk)[:-1]:
+            if size <= self.max_disk:
+                break
+            if REFERENCE_PREFIX + key in keep:
+                continue
+            size -= self.disk.pop(key)
+            if key not in self.memory:
+                self.used.pop(key, None)
+            await asyncio.get_running_loop().run_in_executor(None, self._delete, key)
+
+    def _write(self, key: str, data: bytes):
+        temp = self.path / f"{key}.tmp"
+        temp.write_bytes(data)
+        os.replace(temp, self.path / key)
+
+    def _read(self, key: str) -> bytes:
+        file = self.path / key
+        data = file.read_bytes()
+        os.utime(file)
+        return data
+
+    def _touch(self, key: str):
+        try:
+            os.utime(self.path / key)
+        except OSError:
+            pass
+
+    def _delete(self, key: str):
+        try:
+            (self.path / key).unlink()
+        except OSError:
+            pass
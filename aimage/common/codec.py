@@ -0,0 +1,97 @@
+import json
+import asyncio
+import binascii
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, TypeVar, Union
+
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+
+from aimage.common.constants import CODEC_CHUNK_SIZE, CODEC_OFFLOAD_BYTES, CODEC_THREADS
+
+T = TypeVar("T")
+
+# payload keys holding base64 images, which can be written into json as they are since base64 never needs escaping
+BASE64_FIELDS = ("init_images", "mask", "image")
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def dumps(obj: Any) -> bytes:
+    """ Serializes to json with orjson if it's installed """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj).encode()
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+async def offload(size: int, function: Callable[..., T], *args) -> T:
+    """ Runs the function in the codec threads when its input is large enough to stall the event loop """
+    global _executor
+    if size < CODEC_OFFLOAD_BYTES:
+        return function(*args)
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=CODEC_THREADS, thread_name_prefix="aimage_codec")
+    return await asyncio.get_running_loop().run_in_executor(_executor, function, *args)
+
+
+async def b64encode(data: bytes) -> str:
+    return await offload(len(data), _b64encode, data)
+
+
+async def encode_json(payload: dict) -> bytes:
+    """ The json body of a webui request """
+    size = sum(len(image) for images in _base64_fields(payload).values() for image in images)
+    return await offload(size, _encode_json, payload)
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+# binascii holds the GIL for a whole call, so big inputs are done in pieces to let the event loop run in between
+
+def _b64encode(data: bytes) -> str:
+    view = memoryview(data)
+    return b"".join(binascii.b2a_base64(view[i:i + CODEC_CHUNK_SIZE], newline=False)
+                    for i in range(0, len(view), CODEC_CHUNK_SIZE)).decode("ascii")
+
+
+def _encode_json(payload: dict) -> bytes:
+    fields = _base64_fields(payload)
+    body = dumps({key: value for key, value in payload.items() if key not in fields})
+    if not fields:
+        return body
+    output = bytearray(body[:-1])
+    for key, images in fields.items():
+        # no separator when everything else made an empty object
+        output += b"," if len(output) > 1 else b""
+        output += f'"{key}":'.encode()
+        output += b"[" if isinstance(payload[key], list) else b""
+        for n, image in enumerate(images):
+            output += b',"' if n else b'"'
+            for i in range(0, len(image), CODEC_CHUNK_SIZE):
+                output += image[i:i + CODEC_CHUNK_SIZE].encode("ascii")
+            output += b'"'
+        output += b"]" if isinstance(payload[key], list) else b""
+    output += b"}"
+    return bytes(output)
+
+
+def _base64_fields(payload: dict) -> "dict[str, List[str]]":
+    fields = {}
+    for key in BASE64_FIELDS:
+        value = payload.get(key)
+        if isinstance(value, str) and value.isascii():
+            fields[key] = [value]
+        elif isinstance(value, list) and all(isinstance(image, str) and image.isascii() for image in value):
+            fields[key] = value
+    return fields
@@ -8,6 +8,80 @@ DEFAULT_BADWORDS_BLACKLIST = ["blood", "bloodbath", "crucifixion", "bloody", "fl
                               "xxx", "bondage", "bdsm", "dog collar", "slavegirl", "transparent and translucent", "arse", "labia", "ass", "mammaries", "human centipede", "badonkers", "minge", "massive chests", "big ass", "mommy milker", "booba", "nipple", "booty", "oppai", "bosom", "organs", "breasts", "ovaries", "busty", "penis", "clunge", "phallus", "crotch", "sexy female", "dick", "skimpy", "girth", "thick", "honkers", "vagina", "hooters", "veiny", "knob", "no clothes", "speedo", "au naturale", "no shirt", "bare chest", "nude", "barely dressed", "bra", "risqué", "clear", "scantily clad", "cleavage", "stripped", "full frontal unclothed", "invisible clothes", "wearing nothing", "lingerie with no shirt", "naked", "without clothes on", "negligee", "zero clothes", "taboo", "fascist", "nazi", "prophet mohammed", "slave", "coon", "honkey", "arrested", "jail", "handcuffs", "drugs", "cocaine", "heroin", "meth", "crack"]
 VIEW_TIMEOUT = 10 * 60
 
+QUEUE_STATUS_INTERVAL = 10
+
+# how long running generations get to finish when the cog unloads
+UNLOAD_DRAIN_TIMEOUT = 30
+
+# how many of the next jobs in line may be overtaken by one that reuses the loaded model
+AFFINITY_WINDOW = 10
+
+PROGRESS_POLL_INTERVAL = 1.5
+# discord rate limits message edits, so each status message is edited at most this often
+STATUS_EDIT_INTERVAL = 3
+
+# consecutive failures before an endpoint stops receiving jobs, until a health probe succeeds again
+CIRCUIT_FAILURE_THRESHOLD = 3
+ENDPOINT_PROBE_INTERVAL = 15
+ENDPOINT_PROBE_TIMEOUT = 5
+
+# connections kept open to each webui per set of credentials, and how long idle ones and resolved addresses are kept
+CLIENT_CONNECTION_LIMIT = 8
+CLIENT_KEEPALIVE_TIMEOUT = 60
+CLIENT_DNS_CACHE_TTL = 300
+CLIENT_CONNECT_TIMEOUT = 10
+# how long each kind of webui request may go without receiving data, generations only respond once they're done
+GENERATION_TIMEOUT = 15 * 60
+INTERROGATE_TIMEOUT = 2 * 60
+TERMS_TIMEOUT = 30
+PROGRESS_TIMEOUT = 10
+INTERRUPT_TIMEOUT = 10
+# generated images are read and decoded this many bytes at a time
+RESPONSE_CHUNK_SIZE = 256 * 1024
+
+# base64 and json work on inputs bigger than this runs in these many threads, so it doesn't stall the discord connection
+CODEC_OFFLOAD_BYTES = 256 * 1024
+CODEC_THREADS = 2
+# a multiple of 3, so base64 encoded pieces can be joined
+CODEC_CHUNK_SIZE = 3 * 256 * 1024
+
+# init images are kept once under their hash, the most recently used in memory and the rest on disk
+BLOB_MEMORY_BYTES = 64 * 1024**2
+BLOB_DISK_BYTES = 512 * 1024**2
+# images unused for this long are deleted unless a queued job needs them, the image buttons only last for VIEW_TIMEOUT
+BLOB_MAX_AGE = 60 * 60
+BLOB_EXPIRY_INTERVAL = 10 * 60
+
+# a payload derived from others this many times is flattened into a new base, so lookups stay short
+PAYLOAD_MAX_LAYERS = 8
+
+# how often the event loop's responsiveness is sampled, how many samples are kept, and when a stall gets logged
+LOOP_LAG_INTERVAL = 0.5
+LOOP_LAG_WINDOW = 120
+LOOP_LAG_WARNING = 1.0
+
+# owner supplied blacklist regexes run in a separate process, which is killed if a prompt takes longer than this
+BLACKLIST_REGEX_TIMEOUT = 1
+
+# autocomplete caches are refreshed in the background after this long, give or take the jitter so endpoints don't all refresh together
+AUTOCOMPLETE_TTL = 30 * 60
+AUTOCOMPLETE_TTL_JITTER = 0.1
+# how soon an autocomplete cache that failed to update is tried again
+AUTOCOMPLETE_RETRY_INTERVAL = 60
+AUTOCOMPLETE_CHECK_INTERVAL = 60
+# endpoints whose autocomplete cache is fetched at the same time
+AUTOCOMPLETE_CONCURRENCY = 4
+
+# recent queries remembered by each autocomplete list, as discord sends one per keystroke
+SEARCH_CACHE_SIZE = 64
+# most frequent training tags of a lora that it can be searched by
+LORA_TRIGGER_WORDS = 5
+
+# payload keys that may differ between images generated in the same batch
+BATCH_VARYING_KEYS = ["prompt", "negative_prompt", "seed", "subseed"]
+# fields a batch sends as lists, which stock AUTOMATIC1111 only accepts as single values
+BATCH_LIST_FIELDS = {"prompt", "negative_prompt", "seed"}
+
 AUTO_COMPLETE_UPSCALERS = [
 ]
 
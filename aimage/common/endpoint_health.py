@@ -0,0 +1,54 @@
+import time
+import logging
+from typing import List, Optional
+
+from aimage.common.constants import CIRCUIT_FAILURE_THRESHOLD
+from aimage.common.queue import QueuedJob
+
+log = logging.getLogger("red.bz_cogs.aimage")
+
+
+class EndpointUnavailable(Exception):
+    """ Raised when jobs can't be generated in their endpoint, so they can be moved to another one """
+
+    def __init__(self, jobs: List[QueuedJob]):
+        super().__init__(f"Endpoint unavailable for {len(jobs)} jobs")
+        self.jobs = jobs
+
+
+class EndpointHealth:
+    """
+    Circuit breaker for a webui endpoint, fed by health probes and by real generations.
+    After enough consecutive failures the circuit opens and the endpoint stops receiving jobs,
+    until a probe succeeds and closes it again.
+    """
+
+    def __init__(self, endpoint: str, guild_id: int):
+        self.endpoint = endpoint
+        self.guild_id = guild_id  # whose auth and headers are used to probe it
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.latency: Optional[float] = None
+        self.last_error = ""
+
+    @property
+    def available(self) -> bool:
+        return self.opened_at is None
+
+    def record_success(self, latency: Optional[float] = None):
+        if self.opened_at is not None:
+            log.info(f"Endpoint {self.endpoint} is back up after {time.monotonic() - self.opened_at:.0f}s")
+        self.failures = 0
+        self.opened_at = None
+        if latency is not None:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+
+    def record_failure(self, error: BaseException) -> bool:
+        """ Returns True if this failure opened the circuit """
+        self.failures += 1
+        self.last_error = repr(error)
+        if self.opened_at is None and self.failures >= CIRCUIT_FAILURE_THRESHOLD:
+            log.warning(f"Endpoint {self.endpoint} failed {self.failures} times in a row, no longer sending jobs to it: {self.last_error}")
+            self.opened_at = time.monotonic()
+            return True
+        return False
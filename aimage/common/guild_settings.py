@@ -0,0 +1,41 @@
+from dataclasses import dataclass, field, fields
+from typing import Dict, List, Optional
+
+
+@dataclass(frozen=True)
+class GuildSettings:
+    """ Snapshot of a guild's config and its members' settings, read in bulk and kept until a setting changes """
+    endpoint: Optional[str]
+    nsfw: bool
+    nsfw_tuning: float
+    words_blacklist: List[str]
+    blacklist_regex: str
+    blacklist_fail_open: bool
+    negative_prompt: str
+    cfg: int
+    sampling_steps: int
+    sampler: str
+    checkpoint: Optional[str]
+    vae: Optional[str]
+    adetailer: bool
+    tiledvae: bool
+    width: int
+    height: int
+    max_img2img: int
+    auth: Optional[str]
+    headers: str
+    scheduler: str
+    vip_role: int
+    vip_weight: float
+    followup_weight: float
+    max_queue_guild: int
+    max_queue_user: int
+    queue_deadline: int
+    endpoint_pool: Dict[str, float]
+    member_checkpoints: Dict[int, str] = field(default_factory=dict)
+
+    @classmethod
+    def from_config(cls, guild_data: dict, members_data: Dict[int, dict]) -> "GuildSettings":
+        names = {f.name for f in fields(cls)}
+        return cls(**{key: value for key, value in guild_data.items() if key in names},
+                   member_checkpoints={member_id: data["checkpoint"] for member_id, data in members_data.items() if data.get("checkpoint")})
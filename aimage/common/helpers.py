@@ -9,12 +9,12 @@ from aimage.common.constants import VIEW_TIMEOUT
 
 
 async def send_response(context: Union[commands.Context, discord.Interaction], **kwargs) -> discord.Message:
-    if isinstance(context, discord.Interaction):
-        return await context.followup.send(**kwargs)
-    else:
+    if isinstance(context, commands.Context):
         msg = await context.send(**kwargs)
         asyncio.create_task(context.message.remove_reaction("⏳", context.bot.user))
         return msg
+    else:
+        return await context.followup.send(**kwargs)
 
 
 def round_to_nearest(x, base):
@@ -44,3 +44,10 @@ def get_auth(auth_str: str):
         username, password = auth_str.split(':')
         auth = aiohttp.BasicAuth(username, password)
     return auth
+
+
+def format_wait(seconds: float) -> str:
+    if seconds < 90:
+        return f"{max(1, round(seconds))}s"
+    else:
+        return f"{round(seconds / 60)} min"
@@ -0,0 +1,129 @@
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+import discord
+from redbot.core.bot import Red
+
+log = logging.getLogger("red.bz_cogs.aimage")
+
+
+class JobStore:
+    """ Queued generations saved in a local SQLite database, so they survive cog reloads and bot restarts """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = asyncio.Lock()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    guild_id INTEGER NOT NULL,
+                    channel_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    message_id INTEGER,
+                    application_id INTEGER,
+                    interaction_token TEXT,
+                    endpoint TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    message_content TEXT,
+                    cost REAL NOT NULL,
+                    weight REAL NOT NULL,
+                    enqueued_at REAL NOT NULL,
+                    deadline REAL
+                )
+            """)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    async def add(self, record: dict) -> int:
+        def _add():
+            with self._connect() as conn:
+                columns = ", ".join(record)
+                placeholders = ", ".join(f":{key}" for key in record)
+                cursor = conn.execute(f"INSERT INTO jobs ({columns}) VALUES ({placeholders})",
+                                      {**record, "payload": json.dumps(record["payload"])})
+                return cursor.lastrowid
+        async with self._lock:
+            return await asyncio.get_running_loop().run_in_executor(None, _add)
+
+    async def remove(self, job_id: Optional[int]):
+        if job_id is None:
+            return
+        def _remove():
+            with self._connect() as conn:
+                conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        async with self._lock:
+            await asyncio.get_running_loop().run_in_executor(None, _remove)
+
+    async def remove_user(self, user_id: int):
+        def _remove():
+            with self._connect() as conn:
+                conn.execute("DELETE FROM jobs WHERE user_id = ?", (user_id,))
+        async with self._lock:
+            await asyncio.get_running_loop().run_in_executor(None, _remove)
+
+    async def all(self) -> List[dict]:
+        def _all():
+            with self._connect() as conn:
+                conn.row_factory = sqlite3.Row
+                rows = conn.execute("SELECT * FROM jobs ORDER BY id").fetchall()
+                return [{**dict(row), "payload": json.loads(row["payload"])} for row in rows]
+        async with self._lock:
+            return await asyncio.get_running_loop().run_in_executor(None, _all)
+
+
+class RestoredContext:
+    """
+    Stands in for the original command context or interaction of a job that was saved before a restart.
+    Responses go through the interaction's followup webhook while its token is valid, otherwise to the channel.
+    """
+
+    def __init__(self, bot: Red, guild: discord.Guild, channel: discord.TextChannel, member: discord.Member,
+                 message_id: Optional[int], application_id: Optional[int], interaction_token: Optional[str], enqueued_at: float):
+        self.bot = bot
+        self.guild = guild
+        self.channel = channel
+        self.user = self.author = member
+        self.message = discord.Object(id=message_id or 0)
+        self.message_id = message_id
+        self.followup = self
+        self.webhook = None
+        # interaction tokens last 15 minutes
+        if application_id and interaction_token and time.time() - enqueued_at < 14 * 60:
+            self.webhook = discord.Webhook.partial(application_id, interaction_token, client=bot)
+
+    async def send(self, content: Optional[str] = None, **kwargs) -> discord.Message:
+        kwargs.pop("ephemeral", None)
+        if self.webhook:
+            try:
+                return await self.webhook.send(content, wait=True, **kwargs)
+            except discord.HTTPException:
+                log.debug("Restored interaction token expired, sending to the channel instead", exc_info=True)
+                self.webhook = None
+                if "file" in kwargs:
+                    kwargs["file"].reset()
+        content = f"{self.author.mention} {content or ''}".strip()
+        allowed_mentions = discord.AllowedMentions(users=[self.author])
+        kwargs.pop("allowed_mentions", None)
+        return await self.channel.send(content, allowed_mentions=allowed_mentions, reference=self._reference(), **kwargs)
+
+    async def reply(self, content: str, **_) -> discord.Message:
+        return await self.channel.send(content, reference=self._reference(), allowed_mentions=discord.AllowedMentions.none())
+
+    def _reference(self) -> Optional[discord.MessageReference]:
+        if not self.message_id or self.webhook:
+            return None
+        return discord.MessageReference(message_id=self.message_id, channel_id=self.channel.id, fail_if_not_exists=False)
@@ -0,0 +1,46 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Optional
+
+from aimage.common.constants import LOOP_LAG_INTERVAL, LOOP_LAG_WARNING, LOOP_LAG_WINDOW
+
+log = logging.getLogger("red.bz_cogs.aimage")
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop wakes up a sleeping task, which is how long something blocked it.
+    The discord connection's heartbeats wait just as long.
+    """
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.samples: Deque[float] = deque(maxlen=LOOP_LAG_WINDOW)
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def average(self) -> float:
+        return sum(self.samples) / len(self.samples) if self.samples else 0.0
+
+    @property
+    def peak(self) -> float:
+        return max(self.samples, default=0.0)
+
+    def start(self):
+        if not self.task or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - start - self.interval)
+            self.samples.append(lag)
+            if lag > LOOP_LAG_WARNING:
+                log.warning(f"The event loop was blocked for {lag:.1f} seconds")
@@ -0,0 +1,80 @@
+import re
+import json
+from collections import Counter
+from functools import lru_cache
+from typing import List, Sequence, Tuple
+
+from aimage.common.constants import LORA_TRIGGER_WORDS, SEARCH_CACHE_SIZE
+from aimage.common.search_index import SearchIndex
+
+LORA_FOLDERS = {"lora", "loras", "lycoris", "locon"}
+
+
+def lora_details(entry: dict) -> dict:
+    """ What a LoRA can be searched by, taken from an entry of the webui's /loras """
+    metadata = entry.get("metadata") or {}
+    return {
+        "name": entry["name"],
+        "alias": entry.get("alias") or "",
+        "folder": _lora_folder(entry.get("path") or ""),
+        "triggers": _trigger_words(metadata.get("ss_tag_frequency")),
+    }
+
+
+def _lora_folder(path: str) -> str:
+    # the folders between the webui's lora directory and the file, or just the parent folder if it's not found
+    parts = re.split(r"[\\/]", path)[:-1]
+    for i in range(len(parts) - 1, -1, -1):
+        if parts[i].lower() in LORA_FOLDERS:
+            return "/".join(parts[i + 1:])
+    return parts[-1] if parts else ""
+
+
+def _trigger_words(tag_frequency) -> List[str]:
+    # the tags a lora was trained with the most, which are usually what activates it
+    if isinstance(tag_frequency, str):
+        try:
+            tag_frequency = json.loads(tag_frequency)
+        except ValueError:
+            return []
+    if not isinstance(tag_frequency, dict):
+        return []
+    counts: Counter = Counter()
+    for tags in tag_frequency.values():
+        if isinstance(tags, dict):
+            counts.update({tag.strip(): count for tag, count in tags.items() if isinstance(count, int)})
+    return [tag for tag, _ in counts.most_common(LORA_TRIGGER_WORDS) if tag]
+
+
+class LoraIndex(SearchIndex):
+    """ LoRAs searchable by name, and also by alias, folder or trigger words """
+
+    def __init__(self, loras: Sequence):
+        # older caches only have names
+        details = [lora if isinstance(lora, dict) else {"name": lora} for lora in loras]
+        keywords = [" ".join([lora.get("alias") or "", lora.get("folder") or "", *(lora.get("triggers") or [])]) for lora in details]
+        super().__init__([lora["name"] for lora in details], keywords, source=loras)
+
+    def complete(self, current: str, limit: int = 25) -> List[str]:
+        """ The text of the lora autocomplete, keeping the loras typed before the current one """
+        previous, query, weight = parse_lora_query(current)
+        choices = []
+        for name in self.search(query, limit, strict=True):
+            choice = f"{previous}<lora:{name}:{weight}>"
+            choices.append(choice if len(choice) <= 100 else f"<lora:{name}:{weight}>")
+        return choices
+
+
+@lru_cache(maxsize=SEARCH_CACHE_SIZE)
+def parse_lora_query(current: str) -> Tuple[str, str, str]:
+    """ Splits what's typed into the loras already written, the lora being searched and its weight """
+    head, bracket, query = current.rpartition(">")
+    previous = f"{head}{bracket} " if bracket else ""
+    query = query.strip()
+    if query.lower().startswith("<lora:"):
+        query = query[len("<lora:"):]
+    weight = "1"
+    name, colon, number = query.rpartition(":")
+    if colon and name and re.fullmatch(r"[+-]?\d*\.?\d+", number):
+        query, weight = name, number
+    return previous, query, weight
@@ -0,0 +1,80 @@
+from types import MappingProxyType
+from typing import Any, Dict, Iterator, Mapping, Optional
+
+from aimage.common.constants import PAYLOAD_MAX_LAYERS
+
+
+class Payload(Mapping[str, Any]):
+    """
+    A read-only generation payload made of a base and layers of changed keys,
+    so a follow-up of an image only stores what it changes and shares everything else with its parent.
+    Nested values are shared as well, so they're replaced rather than modified.
+    """
+
+    __slots__ = ("parent", "changes", "depth")
+
+    def __init__(self, base: Mapping[str, Any], changes: Optional[Mapping[str, Any]] = None):
+        if isinstance(base, Payload):
+            self.parent: Optional[Payload] = base
+            self.changes: Mapping[str, Any] = dict(changes or {})
+            self.depth: int = base.depth + 1
+        else:
+            self.parent = None
+            self.changes = MappingProxyType({**base, **changes} if changes else base)
+            self.depth = 0
+
+    @classmethod
+    def of(cls, payload: Mapping[str, Any]) -> "Payload":
+        return payload if isinstance(payload, Payload) else cls(payload)
+
+    def derive(self, changes: Mapping[str, Any]) -> "Payload":
+        """ A payload with some keys changed, in time and memory proportional to the changes """
+        if self.depth + 1 >= PAYLOAD_MAX_LAYERS:
+            return Payload(self.flatten(), changes)
+        return Payload(self, changes)
+
+    def flatten(self) -> Dict[str, Any]:
+        """ A plain dict of the payload to send, which can be modified without affecting it """
+        # built every time rather than kept, since a payload can outlive its job in the image's buttons
+        layers = []
+        payload: Optional[Payload] = self
+        while payload is not None:
+            layers.append(payload.changes)
+            payload = payload.parent
+        flat: Dict[str, Any] = {}
+        for layer in reversed(layers):
+            flat.update(layer)
+        return flat
+
+    def __getitem__(self, key: str) -> Any:
+        payload: Optional[Payload] = self
+        while payload is not None:
+            if key in payload.changes:
+                return payload.changes[key]
+            payload = payload.parent
+        raise KeyError(key)
+
+    def __contains__(self, key: object) -> bool:
+        payload: Optional[Payload] = self
+        while payload is not None:
+            if key in payload.changes:
+                return True
+            payload = payload.parent
+        return False
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.flatten())
+
+    def __len__(self) -> int:
+        return len(self.flatten())
+
+    def __bool__(self) -> bool:
+        payload: Optional[Payload] = self
+        while payload is not None:
+            if payload.changes:
+                return True
+            payload = payload.parent
+        return False
+
+    def __repr__(self) -> str:
+        return f"Payload({self.flatten()!r})"
@@ -0,0 +1,116 @@
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Set
+
+import discord
+
+from aimage.apis.response import ProgressEvent
+from aimage.common.constants import PROGRESS_POLL_INTERVAL, STATUS_EDIT_INTERVAL
+
+log = logging.getLogger("red.bz_cogs.aimage")
+
+
+class ProgressSubscription:
+    """ Holds only the latest progress of a poller, so a slow consumer skips stale events instead of piling them up """
+
+    def __init__(self):
+        self.latest: Optional[ProgressEvent] = None
+        self.updated = asyncio.Event()
+
+    def push(self, event: ProgressEvent):
+        self.latest = event
+        self.updated.set()
+
+    async def next(self) -> ProgressEvent:
+        await self.updated.wait()
+        self.updated.clear()
+        return self.latest  # type: ignore
+
+
+class ProgressPoller:
+    """
+    Polls the progress of a webui while anything is generating in it.
+    Every generation running in the same endpoint shares the same requests.
+    """
+
+    def __init__(self, fetch: Callable[[], Awaitable[dict]], interval: float = PROGRESS_POLL_INTERVAL):
+        self.fetch = fetch
+        self.interval = interval
+        self.subscribers: Set[ProgressSubscription] = set()
+        self.task: Optional[asyncio.Task] = None
+
+    def subscribe(self) -> ProgressSubscription:
+        subscription = ProgressSubscription()
+        self.subscribers.add(subscription)
+        if not self.task or self.task.done():
+            self.task = asyncio.create_task(self._poll())
+        return subscription
+
+    def unsubscribe(self, subscription: ProgressSubscription):
+        self.subscribers.discard(subscription)
+        if not self.subscribers and self.task:
+            # a subscriber arriving before the cancellation lands needs a new task, not the dying one
+            self.task.cancel()
+            self.task = None
+
+    async def _poll(self):
+        while self.subscribers:
+            await asyncio.sleep(self.interval)
+            try:
+                data = await self.fetch()
+            except Exception:  # noqa, reason: progress is cosmetic, the generation itself will report errors
+                log.debug("Failed to poll progress", exc_info=True)
+                continue
+            state = data.get("state") or {}
+            if not state.get("job_count"):
+                continue
+            event = ProgressEvent(progress=data.get("progress") or 0.0,
+                                  eta=data.get("eta_relative") or 0.0,
+                                  step=state.get("sampling_step") or 0,
+                                  steps=state.get("sampling_steps") or 0,
+                                  preview=data.get("current_image"))
+            for subscription in self.subscribers:
+                subscription.push(event)
+
+
+class EditScheduler:
+    """
+    Edits messages at most once every `interval` seconds each.
+    Edits that arrive in between replace each other, so only the latest one is sent.
+    """
+
+    def __init__(self, interval: float = STATUS_EDIT_INTERVAL):
+        self.interval = interval
+        self.pending: Dict[Hashable, Callable[[], Awaitable]] = {}
+        self.last_edit: Dict[Hashable, float] = {}
+        self.tasks: Dict[Hashable, asyncio.Task] = {}
+
+    def schedule(self, key: Hashable, edit: Callable[[], Awaitable]):
+        self.pending[key] = edit
+        if key not in self.tasks:
+            self.tasks[key] = asyncio.create_task(self._flush(key))
+
+    def cancel(self, key: Hashable):
+        self.pending.pop(key, None)
+        self.last_edit.pop(key, None)
+        if task := self.tasks.pop(key, None):
+            task.cancel()
+
+    async def _flush(self, key: Hashable):
+        try:
+            while key in self.pending:
+                wait = self.last_edit.get(key, 0) + self.interval - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                edit = self.pending.pop(key, None)
+                if edit is None:
+                    break
+                self.last_edit[key] = time.monotonic()
+                try:
+                    await edit()
+                except discord.HTTPException:
+                    log.debug("Failed to edit status message", exc_info=True)
+        finally:
+            if self.tasks.get(key) is asyncio.current_task():
+                del self.tasks[key]
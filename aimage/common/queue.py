@@ -0,0 +1,433 @@
+import asyncio
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Coroutine, Dict, List, Mapping, Optional, Set, Tuple, Union
+
+import discord
+from redbot.core import commands
+
+from aimage.common.constants import AFFINITY_WINDOW, BATCH_VARYING_KEYS
+
+log = logging.getLogger("red.bz_cogs.aimage")
+
+
+# compared by identity, since jobs reference each other through their followers
+@dataclass(eq=False)
+class QueuedJob:
+    context: Union[commands.Context, discord.Interaction]
+    payload: Mapping[str, Any]
+    guild_id: int
+    user_id: int
+    endpoint: str
+    callback: Optional[Coroutine] = None
+    message_content: Optional[str] = None
+    cost: float = 1.0
+    weight: float = 1.0
+    enqueued_at: float = field(default_factory=time.monotonic)
+    started_at: Optional[float] = None
+    deadline: Optional[float] = None
+    bypassed_at: Optional[float] = None
+    id: Optional[int] = None
+    seq: int = 0
+    status_message: Optional[discord.Message] = None
+    status_content: str = ""
+    status_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    status_view: Optional[discord.ui.View] = None
+    parent_message_id: Optional[int] = None
+    cancelled: bool = False
+    flight_key: Optional[str] = None
+    leader: Optional["QueuedJob"] = None
+    followers: List["QueuedJob"] = field(default_factory=list)
+
+
+def estimate_cost(payload: Mapping[str, Any]) -> float:
+    """ Rough GPU cost of a payload in megapixel-steps """
+    width, height = payload.get("width", 1024), payload.get("height", 1024)
+    steps = payload.get("steps", 24)
+    if payload.get("init_images"):
+        steps = max(1, int(steps * (payload.get("denoising_strength") or 1)))
+    cost = width * height * steps / 1e6
+
+    if payload.get("enable_hr"):
+        scale = payload.get("hr_scale", 1)
+        hr_steps = payload.get("hr_second_pass_steps") or payload.get("steps", 24)
+        cost += (width * scale) * (height * scale) * hr_steps / 1e6
+
+    adetailer = payload.get("alwayson_scripts", {}).get("ADetailer")
+    if adetailer:
+        args = next((arg for arg in adetailer.get("args", []) if isinstance(arg, dict)), {})
+        cost += args.get("ad_inpaint_width", 512) * args.get("ad_inpaint_height", 512) \
+            * args.get("ad_steps", 28) * args.get("ad_denoising_strength", 0.4) / 1e6
+
+    return cost
+
+
+def model_key(payload: Mapping[str, Any]) -> Tuple[str, str]:
+    """ The checkpoint and VAE the webui has to load for a payload """
+    override_settings = payload.get("override_settings", {})
+    return override_settings.get("sd_model_checkpoint") or "", override_settings.get("sd_vae") or ""
+
+
+def batch_key(payload: Mapping[str, Any]) -> Optional[str]:
+    """ Payloads with the same key only differ in their prompts and seeds, so they can be generated in one batch """
+    if payload.get("init_images") or payload.get("enable_hr") or payload.get("subseed_strength"):
+        return None
+    if not isinstance(payload.get("prompt"), str) or payload.get("batch_size", 1) != 1:
+        return None
+    shared = {key: value for key, value in payload.items() if key not in BATCH_VARYING_KEYS}
+    return json.dumps(shared, sort_keys=True, default=str)
+
+
+def normalize_prompt(prompt: str) -> str:
+    """ Spacing that the webui's tokenizer ignores anyway """
+    return re.sub(r"\s*,\s*", ", ", " ".join(prompt.split())).strip()
+
+
+def payload_key(payload: Mapping[str, Any]) -> Optional[str]:
+    """ Canonical hash of a payload that always produces the same image, or None if its seed is random """
+    if payload.get("seed", -1) in (-1, None):
+        return None
+    if payload.get("subseed_strength") and payload.get("subseed", -1) in (-1, None):
+        return None
+    canonical = dict(payload)
+    for key in ("prompt", "negative_prompt"):
+        if isinstance(canonical.get(key), str):
+            canonical[key] = normalize_prompt(canonical[key])
+    dump = json.dumps(canonical, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(dump.encode()).hexdigest()
+
+
+class FairScheduler:
+    """
+    Weighted fair queuing, first across guilds and then across users within each guild.
+    The guild or user that has received the least service so far goes next,
+    where service is the estimated cost of their jobs divided by the job's priority weight.
+    Priority weights only apply between users of the same guild.
+    Popping can optionally prefer jobs that reuse the loaded model, within a bounded delay.
+    """
+
+    def __init__(self):
+        self.flows: Dict[int, Dict[int, List[Tuple[float, int, QueuedJob]]]] = {}
+        self.guild_service: Dict[int, float] = {}
+        self.user_service: Dict[Tuple[int, int], float] = {}
+        self.size = 0
+        self.reordered = 0
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for users in self.flows.values():
+            for heap in users.values():
+                for _, _, job in heap:
+                    yield job
+
+    def push(self, job: QueuedJob):
+        job.seq = next(self._seq)
+        if job.guild_id not in self.flows:
+            # a newly active flow starts level with the others instead of cashing in its idle time
+            self.guild_service[job.guild_id] = max(self.guild_service.get(job.guild_id, 0), self._min_service(self.guild_service, self.flows))
+            self.flows[job.guild_id] = {}
+        users = self.flows[job.guild_id]
+        if job.user_id not in users:
+            key = (job.guild_id, job.user_id)
+            active = [(job.guild_id, uid) for uid in users]
+            self.user_service[key] = max(self.user_service.get(key, 0), self._min_service(self.user_service, active))
+            users[job.user_id] = []
+        heapq.heappush(users[job.user_id], (-job.weight, job.seq, job))
+        self.size += 1
+
+    def remove(self, job: QueuedJob) -> bool:
+        users = self.flows.get(job.guild_id, {})
+        heap = users.get(job.user_id, [])
+        for i, (_, _, queued_job) in enumerate(heap):
+            if queued_job is job:
+                heap[i] = heap[-1]
+                heap.pop()
+                heapq.heapify(heap)
+                break
+        else:
+            return False
+        if not heap:
+            del users[job.user_id]
+        if not users:
+            del self.flows[job.guild_id]
+        self.size -= 1
+        if not self.size:
+            self.guild_service.clear()
+            self.user_service.clear()
+        return True
+
+    def count(self, guild_id: int, user_id: Optional[int] = None) -> int:
+        users = self.flows.get(guild_id, {})
+        if user_id is not None:
+            return len(users.get(user_id, []))
+        return sum(len(heap) for heap in users.values())
+
+    def pop(self, prefer: Optional[Callable[[QueuedJob], bool]] = None, max_delay: float = 0) -> QueuedJob:
+        if not self.size:
+            raise IndexError("pop from an empty scheduler")
+        if prefer and max_delay > 0:
+            job = self._pick_preferred(prefer, max_delay)
+            self.take(job)
+            return job
+
+        job = self._pop_next(self.flows, self.guild_service, self.user_service)
+        self.size -= 1
+        if not self.size:
+            self.guild_service.clear()
+            self.user_service.clear()
+        return job
+
+    def take(self, job: QueuedJob):
+        """ Removes a specific job as if it had been popped, charging its guild and user """
+        self._charge(self.guild_service, self.user_service, job)
+        self.remove(job)
+
+    def _pick_preferred(self, prefer: Callable[[QueuedJob], bool], max_delay: float) -> QueuedJob:
+        """ The fair choice, unless a preferred job within the window can go first without delaying anyone for too long """
+        window = self.ordered(AFFINITY_WINDOW)
+        if prefer(window[0]):
+            return window[0]
+        now = time.monotonic()
+        for i, job in enumerate(window):
+            if not prefer(job):
+                continue
+            skipped = window[:i]
+            if any(now - (skipped_job.bypassed_at or now) > max_delay for skipped_job in skipped):
+                break
+            for skipped_job in skipped:
+                skipped_job.bypassed_at = skipped_job.bypassed_at or now
+            self.reordered += 1
+            return job
+        return window[0]
+
+    def ordered(self, limit: Optional[int] = None) -> List[QueuedJob]:
+        """ Pending jobs in the order they would run if nothing else was queued """
+        flows = {gid: {uid: list(heap) for uid, heap in users.items()} for gid, users in self.flows.items()}
+        guild_service, user_service = dict(self.guild_service), dict(self.user_service)
+        count = self.size if limit is None else min(limit, self.size)
+        return [self._pop_next(flows, guild_service, user_service) for _ in range(count)]
+
+    @classmethod
+    def _pop_next(cls, flows, guild_service, user_service) -> QueuedJob:
+        guild_id = min(flows, key=lambda gid: (guild_service[gid], cls._head_seq(flows[gid])))
+        users = flows[guild_id]
+        user_id = min(users, key=lambda uid: (user_service[(guild_id, uid)], users[uid][0][1]))
+        _, _, job = heapq.heappop(users[user_id])
+
+        cls._charge(guild_service, user_service, job)
+        if not users[user_id]:
+            del users[user_id]
+        if not users:
+            del flows[guild_id]
+        return job
+
+    @staticmethod
+    def _charge(guild_service: Dict[int, float], user_service: Dict[Tuple[int, int], float], job: QueuedJob):
+        guild_service[job.guild_id] += job.cost
+        user_service[(job.guild_id, job.user_id)] += job.cost / job.weight
+
+    @staticmethod
+    def _head_seq(users: Dict[int, List[Tuple[float, int, QueuedJob]]]) -> int:
+        return min(heap[0][1] for heap in users.values())
+
+    @staticmethod
+    def _min_service(service: dict, active) -> float:
+        return min((service[key] for key in active), default=0)
+
+
+class LatencyModel:
+    """ Running estimate of how many seconds an endpoint takes per megapixel-step """
+
+    def __init__(self, seconds_per_cost: float = 0.2, smoothing: float = 0.2):
+        self.seconds_per_cost = seconds_per_cost
+        self.smoothing = smoothing
+        self.samples = 0
+
+    def observe(self, cost: float, seconds: float):
+        if cost <= 0 or seconds <= 0:
+            return
+        sample = seconds / cost
+        if self.samples:
+            self.seconds_per_cost += self.smoothing * (sample - self.seconds_per_cost)
+        else:
+            self.seconds_per_cost = sample
+        self.samples += 1
+
+    def estimate(self, cost: float) -> float:
+        return cost * self.seconds_per_cost
+
+
+class EndpointQueue:
+    """
+    Pending generations for a single webui endpoint, consumed by up to `concurrency` workers.
+    With a `batch_size` above 1, compatible txt2img jobs are handed to the runner together.
+    A job identical to a queued or running one follows it instead of being queued, and gets a copy of its result.
+    """
+
+    def __init__(self,
+                 endpoint: str,
+                 runner: Callable[[List[QueuedJob]], Awaitable],
+                 concurrency: int = 1,
+                 affinity_delay: float = 0,
+                 batch_size: int = 1):
+        self.endpoint = endpoint
+        self.runner = runner
+        self.concurrency = max(1, concurrency)
+        self.affinity_delay = affinity_delay
+        self.batch_size = max(1, batch_size)
+        self.batched_jobs = 0
+        self.loaded_model: Optional[Tuple[str, str]] = None
+        self.model_swaps = 0
+        self.jobs = FairScheduler()
+        self.workers: Set[asyncio.Task] = set()
+        self.running = 0
+        self.closed = False
+        self.active: Dict[int, QueuedJob] = {}
+        self.in_flight: Dict[str, QueuedJob] = {}
+        self.deduplicated = 0
+        self.latency = LatencyModel()
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def add(self, job: QueuedJob) -> bool:
+        """ Queues a job, returns False if it was attached to an identical job instead """
+        job.leader = None
+        job.flight_key = payload_key(job.payload)
+        leader = self.in_flight.get(job.flight_key) if job.flight_key else None
+        if leader and not leader.cancelled:
+            job.leader = leader
+            leader.followers.append(job)
+            self.deduplicated += 1
+            return False
+        if job.flight_key:
+            self.in_flight[job.flight_key] = job
+        self.jobs.push(job)
+        self._spawn_workers()
+        return True
+
+    def settle(self, job: QueuedJob) -> List[QueuedJob]:
+        """ Stops attaching new requests to a finished job, and returns the ones that were waiting on it """
+        if job.flight_key and self.in_flight.get(job.flight_key) is job:
+            del self.in_flight[job.flight_key]
+        followers = [follower for follower in job.followers if not follower.cancelled]
+        job.followers.clear()
+        return followers
+
+    def release(self, job: QueuedJob):
+        """ Queues the followers of a job that won't produce a result, so they run on their own """
+        for follower in self.settle(job):
+            self.add(follower)
+
+    @property
+    def idle_workers(self) -> int:
+        return self.concurrency - self.running
+
+    def estimates(self) -> List[Tuple[QueuedJob, float]]:
+        """ Pending jobs in the order they are expected to run, along with their expected wait in seconds """
+        now = time.monotonic()
+        slots = [max(0.0, self.latency.estimate(job.cost) - (now - (job.started_at or now))) for job in self.active.values()]
+        slots += [0.0] * (self.concurrency - len(slots))
+        heapq.heapify(slots)
+        results = []
+        for job in self.jobs.ordered():
+            wait = heapq.heappop(slots)
+            results.append((job, wait))
+            heapq.heappush(slots, wait + self.latency.estimate(job.cost))
+        return results
+
+    def backlog(self) -> float:
+        """ Seconds of estimated work remaining, spread across the workers """
+        now = time.monotonic()
+        remaining = sum(max(0.0, self.latency.estimate(job.cost) - (now - (job.started_at or now))) for job in self.active.values())
+        remaining += sum(self.latency.estimate(job.cost) for job in self.jobs)
+        return remaining / self.concurrency
+
+    def set_concurrency(self, concurrency: int):
+        self.concurrency = max(1, concurrency)
+        self._spawn_workers()
+
+    def _spawn_workers(self):
+        while not self.closed and len(self.workers) < self.concurrency and len(self.workers) - self.running < len(self.jobs):
+            task = asyncio.create_task(self._work())
+            self.workers.add(task)
+            task.add_done_callback(self.workers.discard)
+
+    # Some webuis can get overloaded with multiple requests, so each worker sends one at a time
+    async def _work(self):
+        while self.jobs and not self.closed:
+            batch = self._next_batch()
+            seqs = [job.seq for job in batch]
+            now = time.monotonic()
+            for job in batch:
+                job.started_at = now
+                self.active[job.seq] = job
+            self.running += 1
+            try:
+                await self.runner(batch)
+            except Exception:  # noqa, reason: don't crash the worker
+                log.exception(f"aimage task queue for {self.endpoint}")
+            finally:
+                self.running -= 1
+                for seq, job in zip(seqs, batch):
+                    del self.active[seq]
+                    # jobs moved to another endpoint take their followers with them
+                    if job.endpoint == self.endpoint:
+                        self.release(job)
+            await asyncio.sleep(0.5)
+
+    def _next_batch(self) -> List[QueuedJob]:
+        job = self._next_job()
+        key = batch_key(job.payload) if self.batch_size > 1 else None
+        if not key:
+            return [job]
+        batch = [job]
+        for other in self.jobs.ordered():
+            if len(batch) >= self.batch_size:
+                break
+            if batch_key(other.payload) == key:
+                self.jobs.take(other)
+                batch.append(other)
+        self.batched_jobs += len(batch) - 1
+        return batch
+
+    def _next_job(self) -> QueuedJob:
+        loaded_model = self.loaded_model
+        if loaded_model:
+            job = self.jobs.pop(lambda job: model_key(job.payload) == loaded_model, self.affinity_delay)
+        else:
+            job = self.jobs.pop()
+        self.loaded_model = model_key(job.payload)
+        if loaded_model and self.loaded_model != loaded_model:
+            self.model_swaps += 1
+        return job
+
+    async def drain(self, timeout: float):
+        """ Stops taking new jobs and gives the running ones some time to finish before closing """
+        self.closed = True
+        if self.workers:
+            await asyncio.wait(self.workers, timeout=timeout)
+        self.close()
+
+    def close(self):
+        self.closed = True
+        for task in self.workers:
+            task.cancel()
+        for job in self.active.values():
+            for follower in job.followers:
+                if follower.callback:
+                    follower.callback.close()
+        while self.jobs:
+            job = self.jobs.pop()
+            for waiter in [job, *job.followers]:
+                if waiter.callback:
+                    waiter.callback.close()
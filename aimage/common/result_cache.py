@@ -0,0 +1,135 @@
+import os
+import json
+import hashlib
+import asyncio
+import logging
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Iterable, Mapping, Optional
+
+from aimage.apis.response import ImageResponse
+
+log = logging.getLogger("red.bz_cogs.aimage")
+
+
+class ResultCache:
+    """
+    Generated images saved on disk under the hash of the payload and the webui that made them,
+    so a deterministic request can be answered without calling the webui.
+    Different webuis may have different models under the same names, so they don't share images.
+    The least recently used images are deleted once the cache grows past `max_bytes`.
+    """
+
+    def __init__(self, path: Path, max_bytes: int = 0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._load_index()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def size(self) -> int:
+        return sum(self.entries.values())
+
+    def _load_index(self):
+        # the info files are touched on every hit, so their modification time orders the entries by last use
+        infos = sorted(self.path.glob("*.json"), key=lambda file: file.stat().st_mtime)
+        for info_file in infos:
+            try:
+                extension = json.loads(info_file.read_text())["extension"]
+                image_file = info_file.with_suffix(f".{extension}")
+                self.entries[info_file.stem] = info_file.stat().st_size + image_file.stat().st_size
+            except (OSError, ValueError, KeyError):
+                log.warning(f"Removing broken cached image {info_file.stem}")
+                self._delete(info_file.stem)
+
+    @staticmethod
+    def entry_key(key: str, endpoint: str) -> str:
+        return hashlib.sha256(f"{endpoint}\n{key}".encode()).hexdigest()
+
+    async def get(self, key: Optional[str], endpoints: Iterable[str], payload: Mapping[str, Any]) -> Optional[ImageResponse]:
+        """ The image of a payload made by any of the given endpoints """
+        if not key or not self.max_bytes:
+            return None
+        key = next((entry for entry in (self.entry_key(key, endpoint) for endpoint in endpoints) if entry in self.entries), None)
+        if key is None:
+            self.misses += 1
+            return None
+
+        def _read():
+            info_file = self.path / f"{key}.json"
+            info = json.loads(info_file.read_text())
+            data = info_file.with_suffix(f".{info['extension']}").read_bytes()
+            os.utime(info_file)
+            return info, data
+
+        try:
+            info, data = await asyncio.get_running_loop().run_in_executor(None, _read)
+        except (OSError, ValueError, KeyError):
+            log.warning(f"Failed to read cached image {key}", exc_info=True)
+            self.entries.pop(key, None)
+            await asyncio.get_running_loop().run_in_executor(None, self._delete, key)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return ImageResponse(data=data,
+                             payload=payload,
+                             is_nsfw=info["is_nsfw"],
+                             info_string=info["info_string"],
+                             extension=info["extension"])
+
+    async def put(self, key: Optional[str], endpoint: str, response: ImageResponse):
+        if not key or not self.max_bytes or not response.data:
+            return
+        key = self.entry_key(key, endpoint)
+        if key in self.entries:
+            return
+        info = json.dumps({
+            "info_string": response.info_string,
+            "is_nsfw": response.is_nsfw,
+            "extension": response.extension,
+        })
+
+        def _write():
+            (self.path / f"{key}.{response.extension}").write_bytes(response.data)  # type: ignore
+            (self.path / f"{key}.json").write_text(info)
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, _write)
+        except OSError:
+            log.warning(f"Failed to cache image {key}", exc_info=True)
+            return
+        self.entries[key] = len(response.data) + len(info.encode())
+        await self.resize(self.max_bytes)
+
+    async def resize(self, max_bytes: int):
+        """ Sets the size limit, evicting the least recently used images that don't fit """
+        self.max_bytes = max_bytes
+        evicted = []
+        size = self.size
+        while self.entries and size > self.max_bytes:
+            key, entry_size = self.entries.popitem(last=False)
+            size -= entry_size
+            evicted.append(key)
+        for key in evicted:
+            await asyncio.get_running_loop().run_in_executor(None, self._delete, key)
+
+    async def clear(self):
+        keys = list(self.entries)
+        self.entries.clear()
+        for key in keys:
+            await asyncio.get_running_loop().run_in_executor(None, self._delete, key)
+
+    def _delete(self, key: str):
+        for file in self.path.glob(f"{key}.*"):
+            try:
+                file.unlink()
+            except OSError:
+                pass
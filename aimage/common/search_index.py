@@ -0,0 +1,78 @@
+import re
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple
+
+from rapidfuzz import fuzz, process
+
+from aimage.common.constants import SEARCH_CACHE_SIZE
+
+TOKEN_SEPARATORS = re.compile(r"[\s_\-./\\,()\[\]]+")
+
+
+class SearchIndex:
+    """
+    The options of an autocomplete, lowercased and split into words once, instead of on every keystroke.
+    Options containing the query are ranked by where it appears without fuzzy matching,
+    the rest are ranked by rapidfuzz, which only keeps the best results instead of sorting every option.
+    """
+
+    def __init__(self, options: Sequence[str], keywords: Optional[Sequence[str]] = None, source: Optional[Sequence] = None):
+        self.source = options if source is None else source
+        self.options = list(options)
+        self.lowered = [option.lower() for option in self.options]
+        # words of each option after a space, so a word starting with the query is found with a single substring check
+        self.words = [" " + TOKEN_SEPARATORS.sub(" ", option) for option in self.lowered]
+        # other text an option can be found by, ranked after matches of the option itself
+        self.keywords = [keyword.lower() for keyword in keywords] if keywords else None
+        self.results: "OrderedDict[Tuple[str, bool, int], List[str]]" = OrderedDict()
+
+    def __len__(self):
+        return len(self.options)
+
+    def search(self, query: str, limit: int = 25, strict: bool = False) -> List[str]:
+        """ The options that best match the query, strict only keeps close matches """
+        query = query.strip().lower()
+        key = (query, strict, limit)
+        if key in self.results:
+            self.results.move_to_end(key)
+            return self.results[key]
+
+        results = [self.options[i] for i in self._search(query, limit, strict)]
+        self.results[key] = results
+        if len(self.results) > SEARCH_CACHE_SIZE:
+            self.results.popitem(last=False)
+        return results
+
+    def _search(self, query: str, limit: int, strict: bool) -> List[int]:
+        if not query:
+            return list(range(min(limit, len(self.options))))
+
+        # anything containing the query would score 100 anyway, prefixes of the whole name or of a word come first
+        prefixes, words, others, keywords = [], [], [], []
+        for i, option in enumerate(self.lowered):
+            if query not in option:
+                if self.keywords and query in self.keywords[i]:
+                    keywords.append(i)
+                continue
+            if option.startswith(query):
+                prefixes.append(i)
+                if len(prefixes) >= limit:
+                    return prefixes
+            elif " " + query in self.words[i]:
+                words.append(i)
+            else:
+                others.append(i)
+        hits = (prefixes + words + others + keywords)[:limit]
+        if len(hits) >= limit:
+            return hits
+
+        matches = process.extract(query, self.lowered, scorer=fuzz.partial_ratio, processor=None,
+                                  limit=limit + len(hits), score_cutoff=75 if strict else 0)
+        found = set(hits)
+        for _, _, i in matches:
+            if i not in found:
+                hits.append(i)
+                found.add(i)
+            if len(hits) >= limit:
+                break
+        return hits
@@ -3,14 +3,17 @@ import logging
 import asyncio
 import aiohttp
 import discord
-from typing import Coroutine, Optional, Union
+from typing import Any, Coroutine, List, Mapping, Optional, Union
 
 from redbot.core import commands
 
 from aimage.abc import MixinMeta
+from aimage.apis.base_api import BatchUnsupported
 from aimage.apis.response import ImageResponse
+from aimage.common.endpoint_health import EndpointUnavailable
 from aimage.common.helpers import delete_button_after, send_response
 from aimage.common.params import ImageGenParams
+from aimage.common.queue import QueuedJob, estimate_cost, payload_key
 from aimage.views.image_actions import ImageActions
 
 log = logging.getLogger("red.bz_cogs.aimage")
@@ -19,10 +22,11 @@ log = logging.getLogger("red.bz_cogs.aimage")
 class ImageHandler(MixinMeta):
     async def _execute_image_generation(self,
                                         context: Union[commands.Context, discord.Interaction],
-                                        payload: dict = None,
+                                        payload: Optional[Mapping[str, Any]] = None,
                                         params: ImageGenParams = None,
                                         callback: Optional[Coroutine] = None,
-                                        message_content: Optional[str] = None):
+                                        message_content: Optional[str] = None,
+                                        job: Optional[QueuedJob] = None):
         payload = payload or {}
         guild = context.guild
         channel = context.channel
@@ -33,14 +37,30 @@ class ImageHandler(MixinMeta):
         try:
             log.info(f"Starting generation")
             self.generating[user.id] = True
-            for _ in range(3):
+            api = await self.get_api_instance(context, endpoint=job.endpoint if job else None)
+            for attempt in range(3):
                 try:
-                    api = await self.get_api_instance(context)
-                    response: ImageResponse = await api.generate_image(params, payload)
-                except (RuntimeError, aiohttp.ClientOSError, aiohttp.ServerDisconnectedError):
+                    async for event in api.generate_image_stream(params, payload):
+                        if isinstance(event, ImageResponse):
+                            response = event
+                        elif job:
+                            self.report_progress(job, event)
+                except (RuntimeError, aiohttp.ClientOSError, aiohttp.ServerDisconnectedError, asyncio.TimeoutError) as error:
+                    await self.record_endpoint_failure(api.endpoint, error)
+                    health = self.endpoint_health.get(api.endpoint)
+                    # a webui that stopped responding isn't retried, it would likely hang again
+                    timed_out = isinstance(error, asyncio.TimeoutError)
+                    if job and (attempt == 2 or timed_out or health and not health.available):
+                        # the queue can try another endpoint of the guild
+                        raise EndpointUnavailable([job])
+                    if attempt == 2 or timed_out:
+                        raise
                     log.info("Failed to generate, sleeping...")
                     await asyncio.sleep(5)
+                    if job and job.cancelled:
+                        return await self._discard_cancelled(job, callback)
                 else:
+                    self.record_endpoint_success(api.endpoint)
                     break
         except ValueError as error:
             return await send_response(context, content=f":warning: Invalid parameter: {error}", ephemeral=True)
@@ -50,20 +70,121 @@ class ImageHandler(MixinMeta):
         except aiohttp.ClientConnectorError:
             log.exception(f"Failed request in server {guild.id}")
             return await send_response(context, content=":warning: Could not reach the image generator!", ephemeral=True)
+        except EndpointUnavailable:
+            raise
         except Exception:
             log.exception(f"Failed request in server {guild.id}")
             return await send_response(context, content=":warning: Something went wrong!", ephemeral=True)
         else:
             log.info("Finished generation")
+            if api.endpoint in self.queues:
+                self.queues[api.endpoint].latency.observe(estimate_cost(response.payload), response.elapsed)
         finally:
             self.generating[user.id] = False
 
+        if job and job.cancelled:
+            return await self._discard_cancelled(job, callback)
+        await self.result_cache.put(payload_key(response.payload), api.endpoint, response)
+        await self._send_image_response(context, response, callback, message_content)
+        if job:
+            await self._send_to_followers(job, response)
+
+    async def _discard_cancelled(self, job: QueuedJob, callback: Optional[Coroutine]):
+        log.info("Discarding cancelled generation")
+        if callback:
+            callback.close()
+        await self._clear_job_status(job)
+
+    async def _execute_batch_generation(self, jobs: List[QueuedJob]):
+        users = [job.context.user if isinstance(job.context, discord.Interaction) else job.context.author for job in jobs]
+        try:
+            log.info(f"Starting batch generation of {len(jobs)} images")
+            for user in users:
+                self.generating[user.id] = True
+            api = await self.get_api_instance(jobs[0].context, endpoint=jobs[0].endpoint)
+            responses: List[ImageResponse] = await api.generate_batch([job.payload for job in jobs])
+        except BatchUnsupported as error:
+            # the webui doesn't take per-image prompts, so batching stays off for it and these go one at a time
+            log.warning(f"{jobs[0].endpoint} rejected a batched generation, disabling batching for it until the cog reloads: {error}")
+            if jobs[0].endpoint in self.queues:
+                self.queues[jobs[0].endpoint].batch_size = 1
+            for i, job in enumerate(jobs):
+                if job.cancelled:
+                    continue
+                try:
+                    await self._execute_image_generation(job.context, job.payload, None, job.callback, job.message_content, job)
+                except EndpointUnavailable:
+                    raise EndpointUnavailable([job for job in jobs[i:] if not job.cancelled])
+            return
+        except (RuntimeError, aiohttp.ClientOSError, aiohttp.ServerDisconnectedError, asyncio.TimeoutError) as error:
+            await self.record_endpoint_failure(jobs[0].endpoint, error)
+            # the queue can try another endpoint of the guild
+            raise EndpointUnavailable([job for job in jobs if not job.cancelled])
+        except ValueError as error:
+            for job in jobs:
+                if job.cancelled:
+                    continue
+                if job.callback:
+                    job.callback.close()
+                await send_response(job.context, content=f":warning: Invalid parameter: {error}", ephemeral=True)
+            return
+        except Exception:
+            log.exception("Failed batch generation")
+            for job in jobs:
+                if job.cancelled:
+                    continue
+                if job.callback:
+                    job.callback.close()
+                await send_response(job.context, content=":warning: Something went wrong!", ephemeral=True)
+            return
+        else:
+            log.info("Finished batch generation")
+            self.record_endpoint_success(api.endpoint)
+            if api.endpoint in self.queues:
+                self.queues[api.endpoint].latency.observe(sum(job.cost for job in jobs), responses[0].elapsed)
+        finally:
+            for user in users:
+                self.generating[user.id] = False
+
+        for job, response in zip(jobs, responses):
+            if job.cancelled:
+                if job.callback:
+                    job.callback.close()
+                continue
+            message_content = f"-# {job.message_content.strip()}" if job.message_content else None
+            try:
+                await self.result_cache.put(payload_key(response.payload), api.endpoint, response)
+                await self._send_image_response(job.context, response, job.callback, message_content)
+                await self._send_to_followers(job, response)
+            except Exception:  # noqa, reason: one failed response shouldn't stop the others
+                log.exception("Failed to send batched image")
+
+    async def _send_to_followers(self, job: QueuedJob, response: ImageResponse):
+        """ Requests identical to a job get their own copy of its image """
+        for follower in self.queues[job.endpoint].settle(job):
+            message_content = f"-# {follower.message_content.strip()}" if follower.message_content else None
+            try:
+                await self._send_image_response(follower.context, response, follower.callback, message_content)
+            except Exception:  # noqa, reason: one failed response shouldn't stop the others
+                log.exception("Failed to send deduplicated image")
+            await self._finish_job(follower)
+
+    async def _send_image_response(self,
+                                   context: Union[commands.Context, discord.Interaction],
+                                   response: ImageResponse,
+                                   callback: Optional[Coroutine] = None,
+                                   message_content: Optional[str] = None):
+        guild = context.guild
+        channel = context.channel
+        user = context.user if isinstance(context, discord.Interaction) else context.author
+        assert guild and isinstance(channel, discord.TextChannel) and isinstance(user, discord.Member)
+
         if response.is_nsfw and not channel.is_nsfw():
             return await send_response(context, content=f"🔞 Blocked NSFW image.", allowed_mentions=discord.AllowedMentions.none())
 
         id = context.id if isinstance(context, discord.Interaction) else context.message.id
         file = discord.File(io.BytesIO(response.data or b''), filename=f"image_{id}.{response.extension}", spoiler=response.is_nsfw)
-        maxsize = await self.config.guild(guild).max_img2img()
+        maxsize = (await self.get_guild_settings(guild)).max_img2img
         view = ImageActions(self, response.info_string, response.payload, user, channel, maxsize)
 
         msg = await send_response(context, file=file, view=view, content=message_content, allowed_mentions=discord.AllowedMentions.none())
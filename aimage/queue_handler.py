@@ -0,0 +1,438 @@
+import io
+import time
+import base64
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+import discord
+
+from aimage.abc import MixinMeta
+from aimage.apis.response import ProgressEvent
+from aimage.common import codec
+from aimage.common.constants import ENDPOINT_PROBE_INTERVAL, QUEUE_STATUS_INTERVAL
+from aimage.common.endpoint_health import EndpointHealth, EndpointUnavailable
+from aimage.common.helpers import format_wait, send_response
+from aimage.common.job_store import RestoredContext
+from aimage.common.queue import EndpointQueue, QueuedJob, payload_key
+from aimage.views.cancel import CancelView
+
+log = logging.getLogger("red.bz_cogs.aimage")
+
+
+class QueueHandler(MixinMeta):
+
+    async def check_queue_limits(self, guild: discord.Guild, user: discord.Member) -> Optional[str]:
+        """ Returns the reason a new job can't be queued right now, if any """
+        max_global = await self.config.max_queue()
+        if max_global and sum(len(queue) for queue in self.queues.values()) >= max_global:
+            return ":warning: The image queue is full right now, please try again later."
+
+        # a guild's jobs may be spread across the endpoints in its pool
+        settings = await self.get_guild_settings(guild)
+        max_guild = settings.max_queue_guild
+        if max_guild and sum(queue.jobs.count(guild.id) for queue in self.queues.values()) >= max_guild:
+            return f":warning: This server already has {max_guild} images waiting in the queue, please try again later."
+        max_user = settings.max_queue_user
+        if max_user and sum(queue.jobs.count(guild.id, user.id) for queue in self.queues.values()) >= max_user:
+            return f":warning: You already have {max_user} images waiting in the queue, please wait for them to finish."
+        return None
+
+    async def get_endpoints(self, guild: discord.Guild) -> Dict[str, float]:
+        """ The guild's webui endpoints and their weights, starting with its main endpoint """
+        settings = await self.get_guild_settings(guild)
+        endpoints = {}
+        if settings.endpoint:
+            endpoints[settings.endpoint] = 1.0
+        endpoints.update(settings.endpoint_pool)
+        return endpoints
+
+    async def update_endpoints(self, guild: discord.Guild):
+        """ Lets go of what was kept for the endpoints a guild stopped using """
+        self.invalidate_guild_settings(guild.id)
+        endpoints = await self.get_endpoints(guild)
+        await self.api_clients.retire_guild(guild.id, endpoints)
+
+        # endpoints can be shared between guilds, so only the ones nobody uses are forgotten
+        users: Dict[str, int] = {}
+        for guild_id, data in (await self.config.all_guilds()).items():
+            for url in [data["endpoint"], *data["endpoint_pool"]]:
+                if url:
+                    users.setdefault(url, guild_id)
+        for url, health in list(self.endpoint_health.items()):
+            if url not in users:
+                del self.endpoint_health[url]
+            elif health.guild_id == guild.id and url not in endpoints:
+                # it's probed with the auth of a guild that still uses it
+                health.guild_id = users[url]
+        # queues still holding jobs finish them first, and are pruned the next time
+        for url, queue in list(self.queues.items()):
+            if url not in users and not len(queue) and not queue.active and not queue.workers:
+                del self.queues[url]
+
+    async def pick_endpoint(self, guild: discord.Guild, exclude: Optional[str] = None, key: Optional[str] = None) -> Optional[str]:
+        """
+        The least loaded healthy endpoint of a guild, relative to its weight.
+        Without any healthy endpoint, the least loaded one is used anyway, unless we're looking for an alternative.
+        """
+        endpoints = {url: weight for url, weight in (await self.get_endpoints(guild)).items() if url != exclude}
+        if not endpoints:
+            return None
+        for url in endpoints:
+            if url not in self.endpoint_health:
+                self.endpoint_health[url] = EndpointHealth(url, guild.id)
+        if not self.probe_task or self.probe_task.done():
+            self.probe_task = asyncio.create_task(self._probe_endpoints())
+
+        healthy = [url for url in endpoints if self.endpoint_health[url].available]
+        if not healthy:
+            if exclude:
+                return None
+            healthy = list(endpoints)
+        # an identical request can follow the one that's already on its way
+        for url in healthy:
+            if key and url in self.queues and key in self.queues[url].in_flight:
+                return url
+
+        def load(url: str) -> Tuple[float, float]:
+            queue = self.queues.get(url)
+            backlog = queue.backlog() if queue is not None else 0.0
+            return backlog / max(endpoints[url], 0.01), self.endpoint_health[url].latency or 0.0
+        return min(healthy, key=load)
+
+    # Each endpoint gets its own workers, so a slow webui doesn't hold up guilds using a different one
+    async def queue_add(self, job: QueuedJob, persist: bool = True):
+        if persist:
+            job.id = await self.job_store.add(self._job_record(job))
+
+        queue = self.queues.get(job.endpoint)
+        if queue is None:
+            concurrency = (await self.config.endpoint_concurrency()).get(job.endpoint, 1)
+            affinity_delay = await self.config.affinity_delay()
+            batch_size = (await self.config.endpoint_batch_size()).get(job.endpoint, 1)
+            queue = self.queues.setdefault(job.endpoint, EndpointQueue(job.endpoint, self._run_job, concurrency, affinity_delay, batch_size))
+
+        must_wait = queue.idle_workers <= len(queue)
+        if not queue.add(job):
+            await self._set_job_status(job, "⏳ An identical image is already on its way, you'll get a copy of it")
+        elif must_wait:
+            for position, (queued_job, wait) in enumerate(queue.estimates(), 1):
+                if queued_job is job:
+                    await self._set_job_status(job, self._queued_status(position, wait))
+                    break
+
+        if not self.status_task or self.status_task.done():
+            self.status_task = asyncio.create_task(self._update_queue_status())
+
+    async def _run_job(self, jobs: List[QueuedJob]):
+        now = time.monotonic()
+        for job in jobs:
+            if job.deadline and now > job.deadline:
+                await self._drop_job(job, ":warning: Your image waited too long in the queue and was cancelled, please try again later.")
+        jobs = [job for job in jobs if not job.cancelled]
+        if not jobs:
+            return
+
+        queue = self.queues[jobs[0].endpoint]
+        moved: List[QueuedJob] = []
+        try:
+            for job in [waiter for job in jobs for waiter in [job, *job.followers]]:
+                async with job.status_lock:
+                    if job.status_message or isinstance(job.context, discord.Interaction):
+                        await self._edit_job_status(job, f"🎨 Generating, should take about **{format_wait(queue.latency.estimate(job.cost))}**")
+            if len(jobs) == 1:
+                await self._execute_image_generation(jobs[0].context, jobs[0].payload, None, jobs[0].callback, jobs[0].message_content, jobs[0])
+            else:
+                await self._execute_batch_generation(jobs)
+        except asyncio.CancelledError:
+            # interrupted by an unload, the saved jobs will run again when the cog loads
+            raise
+        except EndpointUnavailable as error:
+            for job in error.jobs:
+                if job.cancelled:
+                    continue
+                if await self._reroute_job(job):
+                    moved.append(job)
+                    continue
+                if job.callback:
+                    job.callback.close()
+                await send_response(job.context, content=":warning: Could not reach the image generator!", ephemeral=True)
+            for job in jobs:
+                if job not in moved:
+                    await self.job_store.remove(job.id)
+        except Exception:
+            for job in jobs:
+                await self.job_store.remove(job.id)
+            raise
+        else:
+            for job in jobs:
+                await self.job_store.remove(job.id)
+        finally:
+            for job in jobs:
+                if job not in moved:
+                    await self._clear_job_status(job)
+
+    async def _reroute_job(self, job: QueuedJob) -> bool:
+        """ Moves a job and its followers to another endpoint of its guild, returns False if there is none available """
+        guild = self.bot.get_guild(job.guild_id)
+        endpoint = await self.pick_endpoint(guild, exclude=job.endpoint) if guild else None
+        if not endpoint:
+            return False
+        log.info(f"Moving generation from {job.endpoint} to {endpoint}, user_id={job.user_id}")
+        followers = self.queues[job.endpoint].settle(job)
+        job.endpoint = endpoint
+        job.started_at = None
+        await self.queue_add(job, persist=False)
+        for follower in followers:
+            follower.endpoint = endpoint
+            await self.queue_add(follower, persist=False)
+        return True
+
+    def record_endpoint_success(self, endpoint: str, latency: Optional[float] = None):
+        if endpoint in self.endpoint_health:
+            self.endpoint_health[endpoint].record_success(latency)
+
+    async def record_endpoint_failure(self, endpoint: str, error: BaseException):
+        health = self.endpoint_health.get(endpoint)
+        if not health or not health.record_failure(error):
+            return
+        # the circuit just opened, so the jobs waiting for this endpoint go elsewhere
+        queue = self.queues.get(endpoint)
+        if queue is None:
+            return
+        for job in list(queue.jobs):
+            guild = self.bot.get_guild(job.guild_id)
+            if guild and await self.pick_endpoint(guild, exclude=endpoint) and queue.jobs.remove(job):
+                await self._reroute_job(job)
+
+    async def _probe_endpoints(self):
+        while self.endpoint_health:
+            await asyncio.sleep(ENDPOINT_PROBE_INTERVAL)
+            await asyncio.gather(*(self._probe_endpoint(health) for health in list(self.endpoint_health.values())))
+
+    async def _probe_endpoint(self, health: EndpointHealth):
+        guild = self.bot.get_guild(health.guild_id)
+        if not guild:
+            del self.endpoint_health[health.endpoint]
+            return
+        try:
+            api = await self.get_api_instance(guild=guild, endpoint=health.endpoint)
+            latency = await api.probe()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            await self.record_endpoint_failure(health.endpoint, error)
+        except NotImplementedError:
+            pass
+        else:
+            health.record_success(latency)
+
+    async def _update_queue_status(self):
+        while any(len(queue) for queue in self.queues.values()):
+            await asyncio.sleep(QUEUE_STATUS_INTERVAL)
+            now = time.monotonic()
+            for queue in list(self.queues.values()):
+                # shed jobs that waited past their deadline, so they stop holding memory
+                for job in [job for job in queue.jobs if job.deadline and now > job.deadline]:
+                    if queue.jobs.remove(job):
+                        await self._drop_job(job, ":warning: Your image waited too long in the queue and was cancelled, please try again later.")
+                for position, (job, wait) in enumerate(queue.estimates(), 1):
+                    self._schedule_job_status(job, self._queued_status(position, wait))
+
+    def find_jobs(self, guild_id: int, user_id: Optional[int] = None, parent_message_id: Optional[int] = None) -> List[QueuedJob]:
+        """ Queued and running jobs of a guild, optionally only those of a user or those spun off from an image """
+        jobs = []
+        for queue in self.queues.values():
+            for job in [waiter for job in [*queue.active.values(), *queue.jobs] for waiter in [job, *job.followers]]:
+                if job.guild_id != guild_id or job.cancelled:
+                    continue
+                if user_id is not None and job.user_id != user_id:
+                    continue
+                if parent_message_id is not None and job.parent_message_id != parent_message_id:
+                    continue
+                jobs.append(job)
+        return jobs
+
+    async def cancel_jobs(self, jobs: List[QueuedJob]) -> int:
+        """ Removes queued jobs, and interrupts the webui if nothing else is running on it """
+        cancelled = 0
+        for job in jobs:
+            if job.cancelled:
+                continue
+            queue = self.queues.get(job.endpoint)
+            if job.leader or job.started_at is None and queue is not None and queue.jobs.remove(job):
+                await self._drop_job(job, "Your image was cancelled.")
+                cancelled += 1
+            elif job.started_at is not None and queue is not None and queue.active.get(job.seq) is job:
+                # a finished job is no longer active, and there's nothing left to cancel
+                job.cancelled = True
+                cancelled += 1
+                if queue is not None:
+                    queue.release(job)
+                async with job.status_lock:
+                    if job.status_message:
+                        await self._edit_job_status(job, "Cancelling...")
+
+        for queue in self.queues.values():
+            running = list(queue.active.values())
+            # the webui can't tell which request an interrupt is for, so only interrupt when ours is the only one
+            if queue.running == 1 and running and all(job.cancelled for job in running):
+                try:
+                    api = await self.get_api_instance(running[0].context, endpoint=queue.endpoint)
+                    await api.interrupt()
+                except Exception:
+                    log.exception(f"Failed to interrupt generation in {queue.endpoint}")
+        return cancelled
+
+    async def _drop_job(self, job: QueuedJob, content: str):
+        log.info(f"Dropping queued generation, user_id={job.user_id}: {content}")
+        job.cancelled = True
+        if job.leader:
+            if job in job.leader.followers:
+                job.leader.followers.remove(job)
+        elif job.endpoint in self.queues:
+            self.queues[job.endpoint].release(job)
+        if job.callback:
+            job.callback.close()
+        await self._finish_job(job)
+        try:
+            await send_response(job.context, content=content, ephemeral=True)
+        except discord.HTTPException:
+            pass
+
+    async def _finish_job(self, job: QueuedJob):
+        await self.job_store.remove(job.id)
+        await self._clear_job_status(job)
+
+    async def restore_queued_jobs(self):
+        await self.bot.wait_until_red_ready()
+        records = await self.job_store.all()
+        restored = 0
+        for record in records:
+            guild = self.bot.get_guild(record["guild_id"])
+            channel = guild.get_channel(record["channel_id"]) if guild else None
+            member = guild.get_member(record["user_id"]) if guild else None
+            if guild and not member:
+                try:
+                    member = await guild.fetch_member(record["user_id"])
+                except discord.HTTPException:
+                    member = None
+            if not guild or not isinstance(channel, discord.TextChannel) or not member:
+                await self.job_store.remove(record["id"])
+                continue
+
+            context = RestoredContext(self.bot, guild, channel, member, record["message_id"],
+                                      record["application_id"], record["interaction_token"], record["enqueued_at"])
+            job = QueuedJob(
+                context=context,  # type: ignore
+                payload=record["payload"],
+                guild_id=guild.id,
+                user_id=member.id,
+                endpoint=await self.pick_endpoint(guild, key=payload_key(record["payload"])) or record["endpoint"],
+                message_content=record["message_content"],
+                cost=record["cost"],
+                weight=record["weight"],
+                enqueued_at=time.monotonic() - (time.time() - record["enqueued_at"]),
+                id=record["id"],
+            )
+            if record["deadline"]:
+                job.deadline = job.enqueued_at + record["deadline"]
+            await self.queue_add(job, persist=False)
+            restored += 1
+        if restored:
+            log.info(f"Restored {restored} queued generations")
+
+    @staticmethod
+    def _job_record(job: QueuedJob) -> dict:
+        context = job.context
+        record = {
+            "guild_id": job.guild_id,
+            "channel_id": context.channel.id,  # type: ignore
+            "user_id": job.user_id,
+            "message_id": None,
+            "application_id": None,
+            "interaction_token": None,
+            "endpoint": job.endpoint,
+            "payload": dict(job.payload),
+            "message_content": job.message_content,
+            "cost": job.cost,
+            "weight": job.weight,
+            "enqueued_at": time.time() - (time.monotonic() - job.enqueued_at),
+            "deadline": job.deadline - job.enqueued_at if job.deadline else None,
+        }
+        if isinstance(context, discord.Interaction):
+            record["application_id"] = context.application_id
+            record["interaction_token"] = context.token
+        else:
+            record["message_id"] = context.message.id
+        return record
+
+    @staticmethod
+    def _queued_status(position: int, wait: float) -> str:
+        return f"⏳ Position **{position}** in the queue, estimated wait **{format_wait(wait)}**"
+
+    async def _set_job_status(self, job: QueuedJob, content: str):
+        async with job.status_lock:
+            # once the job starts, the status belongs to the worker
+            if job.started_at is None and content != job.status_content:
+                await self._edit_job_status(job, content)
+
+    def _schedule_job_status(self, job: QueuedJob, content: str):
+        """ Sets the status through the edit scheduler, which merges and spaces out the edits of each message """
+        async def edit():
+            await self._set_job_status(job, content)
+        self.status_edits.schedule(job, edit)
+
+    def report_progress(self, job: QueuedJob, event: ProgressEvent):
+        """ Shows the progress of a running job, editing its status message no faster than discord allows """
+        waited = time.monotonic() - (job.started_at or time.monotonic())
+        # prefix commands only get a status message once the image is taking a while
+        if not job.status_message and not isinstance(job.context, discord.Interaction) and waited < QUEUE_STATUS_INTERVAL:
+            return
+        content = f"🎨 Generating... **{event.progress:.0%}**"
+        if event.steps:
+            content += f" (step {event.step}/{event.steps})"
+        if event.eta:
+            content += f", about **{format_wait(event.eta)}** left"
+        # previews are from before the nsfw filter runs
+        channel = job.context.channel
+        preview = event.preview if isinstance(channel, discord.TextChannel) and channel.is_nsfw() else None
+
+        for waiter in [job, *job.followers]:
+            async def edit(waiter=waiter):
+                async with waiter.status_lock:
+                    if waiter.cancelled:
+                        return
+                    attachments = []
+                    if preview:
+                        image = await codec.offload(len(preview), base64.b64decode, preview)
+                        attachments = [discord.File(io.BytesIO(image), filename="preview.png", spoiler=True)]
+                    await self._edit_job_status(waiter, content, attachments=attachments)
+            self.status_edits.schedule(waiter, edit)
+
+    async def _edit_job_status(self, job: QueuedJob, content: str, **kwargs):
+        if not job.status_view:
+            job.status_view = CancelView(self, job)
+        try:
+            if isinstance(job.context, discord.Interaction):
+                job.status_message = await job.context.edit_original_response(content=content, view=job.status_view, **kwargs)
+            elif job.status_message:
+                await job.status_message.edit(content=content, view=job.status_view, **kwargs)
+            else:
+                kwargs["files"] = kwargs.pop("attachments", [])
+                job.status_message = await job.context.reply(content, view=job.status_view, mention_author=False, **kwargs)
+        except discord.HTTPException:
+            log.debug("Failed to update queue status", exc_info=True)
+        else:
+            job.status_content = content
+
+    async def _clear_job_status(self, job: QueuedJob):
+        self.status_edits.cancel(job)
+        if job.status_view:
+            job.status_view.stop()
+        async with job.status_lock:
+            if job.status_message:
+                try:
+                    await job.status_message.delete()
+                except discord.HTTPException:
+                    pass
+                job.status_message = None
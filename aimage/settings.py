@@ -1,3 +1,4 @@
+import time
 import asyncio
 import logging
 from typing import Optional
@@ -8,13 +9,20 @@ from redbot.core.utils.menus import SimpleMenu # type: ignore
 
 from aimage.abc import MixinMeta
 from aimage.apis.webui_api import WebuiAPI
-from aimage.common.helpers import delete_button_after
+from aimage.common.blacklist import check_regex
+from aimage.common.helpers import delete_button_after, format_wait
+from aimage.common.queue import QueuedJob
 
 log = logging.getLogger("red.bz_cogs.aimage")
 
 
 class Settings(MixinMeta):
 
+    async def cog_after_invoke(self, ctx: commands.Context):
+        # settings commands may have changed the config, so it's read again for the next image
+        if ctx.guild and ctx.command and ctx.command.qualified_name.split()[0] in ("aimage", "ckpt"):
+            self.invalidate_guild_settings(ctx.guild.id)
+
     @commands.command(name="ckpt") # type: ignore
     async def member_checkpoint(self, ctx: commands.Context, *, checkpoint: Optional[str]):
         """
@@ -109,10 +117,314 @@ class Settings(MixinMeta):
             await ctx.send(f"⚠️ Endpoint URL does not end with `/sdapi/v1/`. Continuing anyways...")
 
         await self.config.guild(ctx.guild).endpoint.set(endpoint)
+        self.autocomplete_cache.link(ctx.guild.id, endpoint)
+        await self.update_endpoints(ctx.guild)
 
         msg = await ctx.send("Endpoint set.")
         asyncio.create_task(delete_button_after(msg))
 
+    @aimage.group(name="pool")
+    async def pool(self, _: commands.Context):
+        """
+        Manage extra endpoints for this server. Images go to the least busy endpoint that is responding, relative to its weight.
+        """
+        pass
+
+    @pool.command(name="add")
+    async def pool_add(self, ctx: commands.Context, endpoint: str, weight: float = 1.0):
+        """
+        Add an endpoint to this server's pool, or change its weight. An endpoint with weight 2 is given twice the work.
+        """
+        assert ctx.guild
+        if not endpoint.endswith("/"):
+            endpoint += "/"
+        if weight <= 0 or weight > 100:
+            return await ctx.send("Weight must be above 0 and at most 100.")
+        async with self.config.guild(ctx.guild).endpoint_pool() as endpoint_pool:
+            endpoint_pool[endpoint] = weight
+        await self.update_endpoints(ctx.guild)
+        await ctx.tick(message="✅ Endpoint added to the pool.")
+
+    @pool.command(name="remove")
+    async def pool_remove(self, ctx: commands.Context, endpoint: str):
+        """
+        Remove an endpoint from this server's pool
+        """
+        assert ctx.guild
+        if not endpoint.endswith("/"):
+            endpoint += "/"
+        async with self.config.guild(ctx.guild).endpoint_pool() as endpoint_pool:
+            if endpoint not in endpoint_pool:
+                return await ctx.send(":warning: That endpoint is not in the pool.")
+            del endpoint_pool[endpoint]
+        await self.update_endpoints(ctx.guild)
+        await ctx.tick(message="✅ Endpoint removed from the pool.")
+
+    @pool.command(name="list")
+    async def pool_list(self, ctx: commands.Context):
+        """
+        Show the endpoints of this server and their health
+        """
+        assert ctx.guild
+        endpoints = await self.get_endpoints(ctx.guild)
+        if not endpoints:
+            return await ctx.send(":warning: No endpoint set.")
+        embed = discord.Embed(title="AImage Endpoints", color=await ctx.embed_color())
+        for endpoint, weight in endpoints.items():
+            health = self.endpoint_health.get(endpoint)
+            queue = self.queues.get(endpoint)
+            lines = [f"Weight: `{weight:g}`"]
+            if health and not health.available:
+                lines.append(f"🔴 Down, last error: `{health.last_error[:200]}`")
+            elif health and health.latency is not None:
+                lines.append(f"🟢 Up, responds in `{health.latency * 1000:.0f}` ms")
+            else:
+                lines.append("⚪ Not checked yet")
+            if queue is not None:
+                lines.append(f"Backlog: {format_wait(queue.backlog())}")
+            embed.add_field(name=endpoint[:256], value="\n".join(lines), inline=False)
+        await ctx.send(embed=embed)
+
+    async def _server_endpoint(self, ctx: commands.Context, endpoint: Optional[str]) -> Optional[str]:
+        """ The given endpoint if this server uses it, or the main endpoint if none is given """
+        assert ctx.guild
+        if endpoint is None:
+            endpoint = await self.config.guild(ctx.guild).endpoint()
+            if not endpoint:
+                await ctx.send(":warning: No endpoint set.")
+            return endpoint or None
+        if not endpoint.endswith("/"):
+            endpoint += "/"
+        if endpoint not in await self.get_endpoints(ctx.guild):
+            await ctx.send(":warning: This server doesn't use that endpoint.")
+            return None
+        return endpoint
+
+    @aimage.command(name="concurrency")
+    @checks.is_owner()
+    async def concurrency(self, ctx: commands.Context, concurrency: Optional[int], endpoint: Optional[str]):
+        """
+        Views or sets how many images an endpoint of this server generates at the same time.
+        Defaults to the main endpoint, pool endpoints can be given after the value.
+        Servers sharing an endpoint share this setting. Default is 1.
+        """
+        endpoint = await self._server_endpoint(ctx, endpoint)
+        if not endpoint:
+            return
+        if concurrency is None:
+            current = (await self.config.endpoint_concurrency()).get(endpoint, 1)
+            return await ctx.send(f"`{endpoint}` currently generates `{current}` image(s) at a time.")
+        if concurrency < 1 or concurrency > 8:
+            return await ctx.send("Value must range between 1 and 8.")
+        async with self.config.endpoint_concurrency() as endpoint_concurrency:
+            endpoint_concurrency[endpoint] = concurrency
+        if endpoint in self.queues:
+            self.queues[endpoint].set_concurrency(concurrency)
+        await ctx.tick(message="✅ Endpoint concurrency updated.")
+
+    @aimage.command(name="batch")
+    @checks.is_owner()
+    async def batch(self, ctx: commands.Context, batch_size: Optional[int], endpoint: Optional[str]):
+        """
+        Views or sets how many queued txt2img images with matching settings an endpoint can merge into a single webui call.
+        Different users' prompts and seeds are sent as one batch, which is much faster on the GPU.
+        Only for webuis whose txt2img API takes lists of prompts and seeds, stock AUTOMATIC1111 doesn't and batching turns itself off for it.
+        Defaults to the main endpoint, pool endpoints can be given after the value.
+        Servers sharing an endpoint share this setting. Default is 1, which disables batching.
+        """
+        endpoint = await self._server_endpoint(ctx, endpoint)
+        if not endpoint:
+            return
+        if batch_size is None:
+            current = (await self.config.endpoint_batch_size()).get(endpoint, 1)
+            return await ctx.send(f"`{endpoint}` currently merges up to `{current}` image(s) per call.")
+        if batch_size < 1 or batch_size > 8:
+            return await ctx.send("Value must range between 1 and 8.")
+        async with self.config.endpoint_batch_size() as endpoint_batch_size:
+            endpoint_batch_size[endpoint] = batch_size
+        if endpoint in self.queues:
+            self.queues[endpoint].batch_size = batch_size
+        await ctx.tick(message="✅ Endpoint batch size updated.")
+
+    @aimage.command(name="queue")
+    async def queue_cmd(self, ctx: commands.Context):
+        """
+        Show the pending images for each of this server's endpoints
+        """
+        assert ctx.guild
+        endpoints = await self.get_endpoints(ctx.guild)
+        queues = [queue for endpoint in endpoints if (queue := self.queues.get(endpoint)) is not None and (len(queue) or queue.running)]
+        if not queues:
+            return await ctx.send("The queue is empty.")
+
+        def requester(job: QueuedJob) -> str:
+            mention = f"<@{job.user_id}>" if job.guild_id == ctx.guild.id else "*another server*"  # type: ignore
+            return f"{mention} (+{len(job.followers)})" if job.followers else mention
+
+        embeds = []
+        now = time.monotonic()
+        # a message fits up to 10 embeds
+        for queue in queues[:10]:
+            lines = []
+            for job in queue.active.values():
+                lines.append(f"🎨 {requester(job)} - `{job.cost:.0f}` MP-steps, running for {format_wait(now - (job.started_at or now))}")
+            for position, (job, wait) in enumerate(queue.estimates(), 1):
+                lines.append(f"`{position}.` {requester(job)} - `{job.cost:.0f}` MP-steps, starts in {format_wait(wait)}")
+            if len(lines) > 20:
+                lines = lines[:20] + [f"...and {len(lines) - 20} more"]
+
+            embed = discord.Embed(title="AImage Queue", color=await ctx.embed_color())
+            if len(endpoints) > 1:
+                embed.title = f"AImage Queue - {queue.endpoint}"[:256]
+            embed.description = "\n".join(lines)
+            embed.add_field(name="Backlog", value=format_wait(queue.backlog()))
+            embed.add_field(name="Workers", value=f"{queue.running}/{queue.concurrency}")
+            embed.add_field(name="Speed", value=f"{queue.latency.seconds_per_cost:.3f}s per MP-step")
+            embed.add_field(name="Model swaps", value=f"{queue.model_swaps} ({queue.jobs.reordered} avoided)")
+            if queue.batch_size > 1:
+                embed.add_field(name="Batched", value=f"{queue.batched_jobs} images")
+            if queue.deduplicated:
+                embed.add_field(name="Deduplicated", value=f"{queue.deduplicated} images")
+            embeds.append(embed)
+        embeds[-1].add_field(name="Bot lag", value=f"{self.loop_lag.average * 1000:.0f} ms, up to {self.loop_lag.peak * 1000:.0f} ms")
+        await ctx.send(embeds=embeds, allowed_mentions=discord.AllowedMentions.none())
+
+    @aimage.command(name="cancel")
+    async def cancel(self, ctx: commands.Context, member: Optional[discord.Member]):
+        """
+        Cancels the queued and running images of this server, or only those of a member.
+        """
+        assert ctx.guild
+        jobs = self.find_jobs(ctx.guild.id, member.id if member else None)
+        if not jobs:
+            return await ctx.send("There are no images to cancel.")
+        cancelled = await self.cancel_jobs(jobs)
+        await ctx.send(f"Cancelled {cancelled} images.")
+
+    @aimage.command(name="affinity")
+    @checks.is_owner()
+    async def affinity(self, ctx: commands.Context, seconds: Optional[int]):
+        """
+        Views or sets how many extra seconds a queued image may wait so that images using the already loaded checkpoint and VAE go first.
+        This avoids reloading models in the webui. Set to 0 to disable.
+        """
+        if seconds is None:
+            seconds = await self.config.affinity_delay()
+            return await ctx.send(f"Images may currently wait up to `{seconds}` extra seconds to avoid model swaps.")
+        if seconds < 0 or seconds > 600:
+            return await ctx.send("Value must range between 0 and 600.")
+        await self.config.affinity_delay.set(seconds)
+        for queue in self.queues.values():
+            queue.affinity_delay = seconds
+        await ctx.tick(message="✅ Checkpoint affinity delay updated.")
+
+    @aimage.group(name="cache")
+    @checks.is_owner()
+    async def cache(self, _: commands.Context):
+        """
+        Manage the cache of generated images, which answers repeated requests with a fixed seed without using the webui.
+        """
+        pass
+
+    @cache.command(name="size")
+    async def cache_size(self, ctx: commands.Context, megabytes: Optional[int]):
+        """
+        Views or sets the maximum size of the image cache in megabytes. Set to 0 to disable it.
+        """
+        if megabytes is None:
+            cache = self.result_cache
+            limit = await self.config.result_cache_size()
+            return await ctx.send(f"The cache holds `{len(cache)}` images using `{cache.size / 1024**2:.1f}`/`{limit}` MB, "
+                                  f"with `{cache.hits}` hits and `{cache.misses}` misses since the cog loaded.")
+        if megabytes < 0:
+            return await ctx.send("Value must be 0 or higher.")
+        await self.config.result_cache_size.set(megabytes)
+        await self.result_cache.resize(megabytes * 1024**2)
+        await ctx.tick(message="✅ Image cache size updated.")
+
+    @cache.command(name="seeds")
+    async def cache_seeds(self, ctx: commands.Context):
+        """
+        Toggles picking random seeds in the bot instead of the webui, so that every generated image can be cached.
+        """
+        resolve_seeds = not await self.config.resolve_seeds()
+        await self.config.resolve_seeds.set(resolve_seeds)
+        await ctx.send(f"Random seeds are now picked by the {'bot' if resolve_seeds else 'webui'}.")
+
+    @cache.command(name="clear")
+    async def cache_clear(self, ctx: commands.Context):
+        """
+        Deletes every cached image
+        """
+        await self.result_cache.clear()
+        await ctx.tick(message="✅ Image cache cleared.")
+
+    @aimage.group(name="limit")
+    async def limit(self, _: commands.Context):
+        """
+        Manage how many images can wait in the queue at once. Set a limit to 0 to disable it.
+        """
+        pass
+
+    @limit.command(name="server")
+    async def limit_server(self, ctx: commands.Context, limit: int):
+        """
+        Set how many images this server can have waiting in the queue
+        """
+        assert ctx.guild
+        if limit < 0:
+            return await ctx.send("Value must be 0 or higher.")
+        await self.config.guild(ctx.guild).max_queue_guild.set(limit)
+        await ctx.tick(message="✅ Server queue limit updated.")
+
+    @limit.command(name="user")
+    async def limit_user(self, ctx: commands.Context, limit: int):
+        """
+        Set how many images each member can have waiting in the queue
+        """
+        assert ctx.guild
+        if limit < 0:
+            return await ctx.send("Value must be 0 or higher.")
+        await self.config.guild(ctx.guild).max_queue_user.set(limit)
+        await ctx.tick(message="✅ User queue limit updated.")
+
+    @limit.command(name="global")
+    @checks.is_owner()
+    async def limit_global(self, ctx: commands.Context, limit: int):
+        """
+        Set how many images can be waiting in the queue across all servers
+        """
+        if limit < 0:
+            return await ctx.send("Value must be 0 or higher.")
+        await self.config.max_queue.set(limit)
+        await ctx.tick(message="✅ Global queue limit updated.")
+
+    @limit.command(name="deadline")
+    async def limit_deadline(self, ctx: commands.Context, seconds: int):
+        """
+        Cancel images that have been waiting in the queue for longer than this many seconds
+        """
+        assert ctx.guild
+        if seconds < 0:
+            return await ctx.send("Value must be 0 or higher.")
+        await self.config.guild(ctx.guild).queue_deadline.set(seconds)
+        await ctx.tick(message="✅ Queue deadline updated.")
+
+    @aimage.command(name="followup_weight")
+    async def followup_weight(self, ctx: commands.Context, weight: Optional[float]):
+        """
+        Views or sets the queue priority weight of rerolls, changes and variations made with the image buttons.
+        A weight of 2 makes them count as half as expensive when sharing the queue with others.
+        """
+        assert ctx.guild
+        if weight is None:
+            weight = await self.config.guild(ctx.guild).followup_weight()
+            return await ctx.send(f"The follow-up weight is currently `{weight:.2f}`")
+        if weight < 0.1 or weight > 10:
+            return await ctx.send("Value must range between 0.1 and 10.")
+        await self.config.guild(ctx.guild).followup_weight.set(weight)
+        await ctx.tick(message="✅ Follow-up weight updated.")
+
     @aimage.command(name="nsfw")
     async def nsfw(self, ctx: commands.Context):
         """
@@ -393,6 +705,7 @@ class Settings(MixinMeta):
         if not added:
             return await ctx.send("No words added")
         await self.config.guild(ctx.guild).words_blacklist.set(current_words)
+        self._blacklist_changed(ctx.guild)
         return await ctx.send(f"Added words `{', '.join(added)}` to the blacklist")
     
     @blacklist.command(name="regex")
@@ -409,8 +722,28 @@ class Settings(MixinMeta):
             else:
                 await ctx.send(f"Current regex\n```re\n{regex}```")
         else:
-            await self.config.guild(ctx.guild).blacklist_regex.set(regex.strip())
-            await ctx.send(f"Set regex\n```re\n{regex.strip()}```")
+            regex = regex.strip()
+            if problems := check_regex(regex):
+                return await ctx.send(":warning: Regex not set, it could take too long to check some prompts:\n"
+                                      + "\n".join(f"- {problem}" for problem in problems)
+                                      + "\nUse an atomic group `(?>...)` or a possessive quantifier like `a++` instead, or install `google-re2`.")
+            await self.config.guild(ctx.guild).blacklist_regex.set(regex)
+            self._blacklist_changed(ctx.guild)
+            await ctx.send(f"Set regex\n```re\n{regex}```")
+
+    @blacklist.command(name="failopen")
+    @commands.is_owner()
+    async def blacklist_fail_open(self, ctx: commands.Context):
+        """
+        Toggles whether prompts are allowed when the blacklist regex takes too long to check them
+
+        By default they're rejected.
+        """
+        assert ctx.guild
+        new = not await self.config.guild(ctx.guild).blacklist_fail_open()
+        await self.config.guild(ctx.guild).blacklist_fail_open.set(new)
+        self._blacklist_changed(ctx.guild)
+        await ctx.send(f"Prompts that time out the blacklist regex will now be {'`allowed`' if new else '`rejected`'}")
 
     @blacklist.command(name="remove")
     async def blacklist_remove(self, ctx: commands.Context, *words: str):
@@ -430,6 +763,7 @@ class Settings(MixinMeta):
         if not removed:
             return await ctx.send("No words removed")
         await self.config.guild(ctx.guild).words_blacklist.set(current_words)
+        self._blacklist_changed(ctx.guild)
         return await ctx.send(f"Removed words `{', '.join(removed)}` from blacklist")
 
     @blacklist.command(name="list", aliases=["show"])
@@ -466,8 +800,14 @@ class Settings(MixinMeta):
         """
         assert ctx.guild
         await self.config.guild(ctx.guild).words_blacklist.set([])
+        self._blacklist_changed(ctx.guild)
         await ctx.tick(message="✅ Blacklist cleared.")
 
+    def _blacklist_changed(self, guild: discord.Guild):
+        # the matcher is rebuilt from fresh settings on the next prompt
+        self.invalidate_guild_settings(guild.id)
+        self.blacklists.pop(guild.id, None)
+
     @aimage.command()
     @checks.is_owner()
     @checks.bot_in_a_guild()
@@ -488,6 +828,21 @@ class Settings(MixinMeta):
         """
         pass
 
+    @vip.command(name="weight")
+    async def vip_weight(self, ctx: commands.Context, weight: Optional[float]):
+        """
+        Views or sets the queue priority weight of the VIP role.
+        A weight of 2 makes their images count as half as expensive when sharing the queue with others.
+        """
+        assert ctx.guild
+        if weight is None:
+            weight = await self.config.guild(ctx.guild).vip_weight()
+            return await ctx.send(f"The VIP weight is currently `{weight:.2f}`")
+        if weight < 0.1 or weight > 10:
+            return await ctx.send("Value must range between 0.1 and 10.")
+        await self.config.guild(ctx.guild).vip_weight.set(weight)
+        await ctx.tick(message="✅ VIP weight updated.")
+
     @vip.command(name="view")
     async def vip_view(self, ctx: commands.Context):
         """
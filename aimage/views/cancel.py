@@ -0,0 +1,33 @@
+import discord
+
+from aimage.abc import MixinMeta
+from aimage.common.queue import QueuedJob
+
+
+class CancelView(discord.ui.View):
+    def __init__(self, cog: MixinMeta, job: QueuedJob):
+        super().__init__(timeout=None)
+        self.bot = cog.bot
+        self.cancel_jobs = cog.cancel_jobs
+        self.job = job
+
+    @discord.ui.button(emoji="✖️", label="Cancel") # type: ignore
+    async def cancel(self, interaction: discord.Interaction, _: discord.ui.Button):
+        if not await self.check_if_can_cancel(interaction):
+            return await interaction.response.send_message(content=":warning: Only the requester and members with `Manage Messages` permission can cancel this image!", ephemeral=True)
+
+        # interrupting the webui may take longer than discord waits for a response
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        if not await self.cancel_jobs([self.job]):
+            return await interaction.followup.send(":warning: This image could not be cancelled, it may have already finished.", ephemeral=True)
+        await interaction.followup.send("Image cancelled.", ephemeral=True)
+        self.stop()
+
+    async def check_if_can_cancel(self, interaction: discord.Interaction):
+        if interaction.user.id == self.job.user_id:
+            return True
+        assert interaction.guild and interaction.channel
+        member = interaction.guild.get_member(interaction.user.id)
+        if not member:
+            return False
+        return await self.bot.is_owner(member) or interaction.channel.permissions_for(member).manage_messages
@@ -1,7 +1,6 @@
 import asyncio
 import discord
 import discord.ui as ui
-from copy import deepcopy
 
 from aimage.common.constants import ADETAILER_ARGS
 from aimage.views.image_actions import ImageActions
@@ -14,7 +13,7 @@ class HiresModal(ui.Modal):
         self.parent_view = parent_view
         self.parent_interaction = parent_interaction
         self.parent_button = parent_view.button_upscale
-        self.payload = deepcopy(parent_view.payload)
+        self.payload = parent_view.payload
         self.generate_image = parent_view.generate_image
 
         upscalers = sorted(set(parent_view.cache[parent_interaction.guild.id].get("upscalers", [])))
@@ -69,29 +68,32 @@ class HiresModal(ui.Modal):
         assert isinstance(self.denoising_select.component, discord.ui.Select)
         assert isinstance(self.adetailer_select.component, discord.ui.Select)
 
-        self.payload["enable_hr"] = True
-        self.payload["hr_upscaler"] = self.upscaler_select.component.values[0]
-        self.payload["hr_scale"] = float(self.scale_select.component.values[0])
-        self.payload["denoising_strength"] = float(self.denoising_select.component.values[0])
-        self.payload["hr_second_pass_steps"] = int(self.payload["steps"]) // 2
-        self.payload["hr_prompt"] = self.payload["prompt"]
-        self.payload["hr_negative_prompt"] = self.payload["negative_prompt"]
-        self.payload["hr_resize_x"] = 0
-        self.payload["hr_resize_y"] = 0
-
         params = self.parent_view.get_params_dict() or {}
-        self.payload["seed"] = int(params["Seed"])
-        self.payload["subseed"] = int(params.get("Variation seed", -1))
-        self.payload["subseed_strength"] = float(params.get("Variation seed strength", 0))
+        changes = {
+            "enable_hr": True,
+            "hr_upscaler": self.upscaler_select.component.values[0],
+            "hr_scale": float(self.scale_select.component.values[0]),
+            "denoising_strength": float(self.denoising_select.component.values[0]),
+            "hr_second_pass_steps": int(self.payload["steps"]) // 2,
+            "hr_prompt": self.payload["prompt"],
+            "hr_negative_prompt": self.payload["negative_prompt"],
+            "hr_resize_x": 0,
+            "hr_resize_y": 0,
+            "seed": int(params["Seed"]),
+            "subseed": int(params.get("Variation seed", -1)),
+            "subseed_strength": float(params.get("Variation seed strength", 0)),
+        }
 
+        # the scripts are shared with the original payload, so they're replaced instead of modified
+        scripts = self.payload["alwayson_scripts"]
         if self.adetailer and bool(int(self.adetailer_select.component.values[0])):
-            self.payload["alwayson_scripts"].update(ADETAILER_ARGS)
-        elif "ADetailer" in self.payload["alwayson_scripts"]:
-            del self.payload["alwayson_scripts"]["ADetailer"]
+            changes["alwayson_scripts"] = {**scripts, **ADETAILER_ARGS}
+        elif "ADetailer" in scripts:
+            changes["alwayson_scripts"] = {key: value for key, value in scripts.items() if key != "ADetailer"}
 
         await interaction.response.defer(thinking=True)
         message_content = f"Upscale requested by {interaction.user.mention}"
-        await self.generate_image(interaction, payload=self.payload, callback=self.edit_callback(), message_content=message_content)
+        await self.generate_image(interaction, payload=self.payload.derive(changes), callback=self.edit_callback(), message_content=message_content)
         
         self.parent_button.disabled = True
         await self.parent_interaction.message.edit(view=self.parent_view)
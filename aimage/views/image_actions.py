@@ -1,6 +1,6 @@
 import asyncio
 from collections import OrderedDict
-from typing import Optional
+from typing import Any, Mapping, Optional
 
 import discord
 from redbot.core.bot import Red
@@ -8,14 +8,15 @@ from redbot.core.bot import Red
 from aimage.abc import MixinMeta
 from aimage.common.constants import PARAM_GROUP_REGEX, PARAM_REGEX, PARAMS_BLACKLIST, VIEW_TIMEOUT
 from aimage.common.helpers import delete_button_after
+from aimage.common.payload import Payload
 from aimage.views.params import ParamsView
 
 
 class ImageActions(discord.ui.View):
-    def __init__(self, cog: MixinMeta, image_info: str, payload: dict, author: discord.Member, channel: discord.TextChannel, maxsize: int):
+    def __init__(self, cog: MixinMeta, image_info: str, payload: Mapping[str, Any], author: discord.Member, channel: discord.TextChannel, maxsize: int):
         super().__init__(timeout=VIEW_TIMEOUT)
         self.info_string = image_info
-        self.payload = payload
+        self.payload = Payload.of(payload)
         self.bot: Red = cog.bot
         self.config = cog.config
         self.cache = cog.autocomplete_cache
@@ -23,6 +24,8 @@ class ImageActions(discord.ui.View):
         self.channel = channel
         self.maxsize = maxsize
         self.generate_image = cog.generate_image
+        self.find_jobs = cog.find_jobs
+        self.cancel_jobs = cog.cancel_jobs
 
         self.button_caption = discord.ui.Button(emoji='🔎')
         self.button_caption.callback = self.get_caption
@@ -81,6 +84,8 @@ class ImageActions(discord.ui.View):
 
         self.button_delete.disabled = True
         await interaction.message.delete()
+        # variations and upscales of a deleted image are no longer wanted
+        await self.cancel_jobs(self.find_jobs(self.channel.guild.id, parent_message_id=interaction.message.id))
 
         prompt = self.payload["prompt"]
         if interaction.user.id == self.og_user.id:
@@ -1,7 +1,6 @@
 import asyncio
 import discord
 import discord.ui as ui
-from copy import deepcopy
 
 from aimage.views.image_actions import ImageActions
 
@@ -11,7 +10,7 @@ class ModifyModal(ui.Modal):
         super().__init__(title="Image Generation")
         self.parent_view = parent_view
         self.parent_button = parent_view.button_modify
-        self.payload = deepcopy(parent_view.payload)
+        self.payload = parent_view.payload
         self.generate_image = parent_view.generate_image
 
         self.prompt_edit = ui.Label(
@@ -50,20 +49,22 @@ class ModifyModal(ui.Modal):
         assert isinstance(self.seed_select.component, discord.ui.Select)
         
         same_prompt = self.prompt_edit.component.value == self.payload["prompt"] and self.negative_prompt_edit.component.value == self.payload["negative_prompt"]
-        self.payload["prompt"] = self.prompt_edit.component.value
-        self.payload["negative_prompt"] = self.negative_prompt_edit.component.value
+        changes = {
+            "prompt": self.prompt_edit.component.value,
+            "negative_prompt": self.negative_prompt_edit.component.value,
+        }
 
         reroll = bool(int(self.seed_select.component.values[0]))
         if reroll:
-            self.payload["seed"] = -1
-            self.payload["subseed"] = -1
-            self.payload["subseed_strength"] = 0
+            changes.update({"seed": -1, "subseed": -1, "subseed_strength": 0})
         else:
             params = self.parent_view.get_params_dict() or {}
-            self.payload["seed"] = int(params.get("Seed", -1))
-            self.payload["subseed"] = int(params.get("Variation seed", -1))
-            self.payload["subseed_strength"] = float(params.get("Variation seed strength", 0))
+            changes.update({
+                "seed": int(params.get("Seed", -1)),
+                "subseed": int(params.get("Variation seed", -1)),
+                "subseed_strength": float(params.get("Variation seed strength", 0)),
+            })
 
         await interaction.response.defer(thinking=True)
         message_content = f"Reroll requested by {interaction.user.mention}" if same_prompt else f"Change requested by {interaction.user.mention}"
-        await self.generate_image(interaction, payload=self.payload, message_content=message_content)
+        await self.generate_image(interaction, payload=self.payload.derive(changes), message_content=message_content)
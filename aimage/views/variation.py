@@ -1,7 +1,6 @@
 import asyncio
 import discord
 import discord.ui as ui
-from copy import deepcopy
 
 from aimage.views.image_actions import ImageActions
 
@@ -11,7 +10,7 @@ class VariationModal(ui.Modal):
         super().__init__(title="Make image variation")
         self.parent_view = parent_view
         self.parent_button = parent_view.button_variation
-        self.payload = deepcopy(parent_view.payload)
+        self.payload = parent_view.payload
         self.generate_image = parent_view.generate_image
 
         default_strength = 5
@@ -47,10 +46,12 @@ class VariationModal(ui.Modal):
         reroll = bool(int(self.subseed_select.component.values[0])) if self.subseed_select.component.values else True
         strength = float(self.variation_select.component.values[0]) / 100
         params = self.parent_view.get_params_dict() or {}
-        self.payload["seed"] = int(params.get("Seed", -1))
-        self.payload["subseed"] = -1 if reroll else int(params.get("Variation seed", -1))
-        self.payload["subseed_strength"] = strength
+        payload = self.payload.derive({
+            "seed": int(params.get("Seed", -1)),
+            "subseed": -1 if reroll else int(params.get("Variation seed", -1)),
+            "subseed_strength": strength,
+        })
 
         await interaction.response.defer(thinking=True)
         message_content = f"Variation requested by {interaction.user.mention}"
-        await self.generate_image(interaction, payload=self.payload, message_content=message_content)
+        await self.generate_image(interaction, payload=payload, message_content=message_content)
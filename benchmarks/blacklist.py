@@ -0,0 +1,47 @@
+"""
+Cost per prompt of checking the aimage blacklist, comparing the old per-word substring scan with the compiled matcher.
+
+Run from the repository root with Red installed:
+    python -m benchmarks.blacklist
+"""
+import random
+import string
+import timeit
+
+from aimage.common.blacklist import BlacklistMatcher
+from aimage.common.constants import DEFAULT_BADWORDS_BLACKLIST
+
+PROMPT_WORDS = ["1girl", "solo", "long hair", "looking at viewer", "smile", "outdoors", "sky", "cloud", "day",
+                "masterpiece", "best quality", "detailed background", "scenery", "tree", "flower", "river"]
+
+
+def random_words(count: int, rng: random.Random):
+    return ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 12))) for _ in range(count)]
+
+
+def random_prompt(length: int, rng: random.Random):
+    return ", ".join(rng.choices(PROMPT_WORDS, k=length))
+
+
+def bench(name: str, words, prompts, number: int = 200):
+    matcher = BlacklistMatcher(words)
+    old = timeit.timeit(lambda: [any(word in prompt.lower() for word in words) for prompt in prompts], number=number)
+    new = timeit.timeit(lambda: [matcher.search_words(prompt) for prompt in prompts], number=number)
+    calls = number * len(prompts)
+    print(f"{name:<28} any(): {old / calls * 1e6:8.2f} µs/prompt   matcher: {new / calls * 1e6:8.2f} µs/prompt   {old / new:5.1f}x")
+
+
+def main():
+    rng = random.Random(0)
+    prompts = [random_prompt(rng.randint(5, 40), rng) for _ in range(200)]
+    bench(f"default list ({len(DEFAULT_BADWORDS_BLACKLIST)} words)", DEFAULT_BADWORDS_BLACKLIST, prompts)
+    for size in (1_000, 10_000):
+        words = DEFAULT_BADWORDS_BLACKLIST + random_words(size, rng)
+        bench(f"{size + len(DEFAULT_BADWORDS_BLACKLIST)} words", words, prompts, number=20)
+
+    build = timeit.timeit(lambda: BlacklistMatcher(DEFAULT_BADWORDS_BLACKLIST + random_words(10_000, random.Random(1))), number=5) / 5
+    print(f"building a 10k word matcher: {build * 1e3:.1f} ms, only done when the blacklist changes")
+
+
+if __name__ == "__main__":
+    main()
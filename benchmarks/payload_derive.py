@@ -0,0 +1,101 @@
+"""
+Time and memory to create a follow-up job from an image's payload,
+comparing the old `deepcopy` + modify with deriving an immutable payload.
+Memory is measured again after hashing each follow-up, like the queue does, since the follow-ups outlive their jobs.
+
+Run from the repository root with Red installed:
+    python -m benchmarks.payload_derive
+"""
+import time
+import tracemalloc
+from copy import deepcopy
+
+from aimage.common.constants import ADETAILER_ARGS, TILED_VAE_ARGS
+from aimage.common.payload import Payload
+from aimage.common.queue import payload_key
+
+FOLLOWUPS = 100
+
+# what the upscale button changes
+CHANGES = {
+    "enable_hr": True,
+    "hr_upscaler": "Latent",
+    "hr_scale": 1.5,
+    "denoising_strength": 0.4,
+    "hr_second_pass_steps": 12,
+    "hr_prompt": "masterpiece, best quality, a cat",
+    "hr_negative_prompt": "(worst quality, low quality:1.4)",
+    "hr_resize_x": 0,
+    "hr_resize_y": 0,
+    "seed": 1234,
+    "subseed": -1,
+    "subseed_strength": 0.0,
+}
+
+
+def make_payload(init_image: str = "") -> dict:
+    payload = {
+        "prompt": "masterpiece, best quality, a cat",
+        "negative_prompt": "(worst quality, low quality:1.4)",
+        "styles": [],
+        "cfg_scale": 7,
+        "steps": 24,
+        "seed": 1234,
+        "subseed": -1,
+        "subseed_strength": 0,
+        "sampler_name": "Euler a",
+        "scheduler": "Automatic",
+        "override_settings": {"sd_model_checkpoint": "model", "sd_vae": "Automatic"},
+        "width": 1024,
+        "height": 1024,
+        "alwayson_scripts": {**ADETAILER_ARGS, **TILED_VAE_ARGS},
+        "script_name": "CensorScript",
+        "script_args": [True, True, False],
+    }
+    if init_image:
+        payload["init_images"] = [init_image]
+    return payload
+
+
+def old(payload: dict):
+    followup = deepcopy(payload)
+    followup.update(CHANGES)
+    return followup
+
+
+def new(payload: Payload):
+    return payload.derive(CHANGES)
+
+
+def measure(function, payload):
+    start = time.perf_counter()
+    for _ in range(1000):
+        function(payload)
+    elapsed = (time.perf_counter() - start) / 1000
+
+    tracemalloc.start()
+    followups = [function(payload) for _ in range(FOLLOWUPS)]
+    size, _ = tracemalloc.get_traced_memory()
+    for followup in followups:
+        payload_key(followup)
+    size_after_key, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del followups
+    return elapsed, size / FOLLOWUPS, size_after_key / FOLLOWUPS
+
+
+def main():
+    cases = {
+        "txt2img": make_payload(),
+        "img2img": make_payload("blob:" + "0" * 64),
+    }
+    for name, payload in cases.items():
+        print(name)
+        for label, function, argument in (("deepcopy", old, payload), ("derive", new, Payload(payload))):
+            elapsed, size, size_after_key = measure(function, argument)
+            print(f"  {label:<9} {elapsed * 1e6:8.1f} us per follow-up   {size / 1024:6.1f} KB per follow-up, {size_after_key / 1024:6.1f} KB after hashing")
+        assert dict(new(Payload(payload))) == old(payload)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Peak memory and longest event loop block while reading a webui generation response,
+comparing the old `response.json()` + `b64decode` with the streaming parser.
+
+Run from the repository root with Red installed:
+    python -m benchmarks.response_decode
+"""
+import os
+import json
+import time
+import base64
+import tracemalloc
+
+from aimage.apis.response_stream import GenerationResponseParser
+from aimage.common.constants import RESPONSE_CHUNK_SIZE
+
+# rough png sizes of a detailed image, random bytes so nothing compresses
+SIZES = {"1024x1024": 1024 * 1024 * 2, "2048x2048": 2048 * 2048 * 2}
+
+
+def make_body(image: bytes) -> bytes:
+    info = {"infotexts": ["masterpiece, best quality\nSteps: 24, Sampler: Euler a"], "extra_generation_params": {}}
+    return json.dumps({"images": [base64.b64encode(image).decode()], "parameters": {"prompt": "masterpiece"}, "info": json.dumps(info)}).encode()
+
+
+def chunks(body: bytes):
+    for i in range(0, len(body), RESPONSE_CHUNK_SIZE):
+        yield body[i:i + RESPONSE_CHUNK_SIZE]
+
+
+def old(body: bytes):
+    # aiohttp reads the whole body while yielding to the loop, then decodes and parses it in one go
+    data = bytearray()
+    for chunk in chunks(body):
+        data += chunk
+    start = time.perf_counter()
+    r = json.loads(bytes(data).decode())
+    image = base64.b64decode(r["images"][0])
+    json.loads(r["info"])
+    return image, time.perf_counter() - start
+
+
+def new(body: bytes):
+    parser = GenerationResponseParser(1)
+    longest = 0.0
+    for chunk in chunks(body):
+        start = time.perf_counter()
+        parser.feed(chunk)
+        longest = max(longest, time.perf_counter() - start)
+    images, fields = parser.result()
+    json.loads(json.loads(fields["info"]))
+    return images[0], longest
+
+
+def measure(function, body: bytes):
+    tracemalloc.start()
+    image, blocked = function(body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return image, peak, blocked
+
+
+def main():
+    for name, size in SIZES.items():
+        image = os.urandom(size)
+        body = make_body(image)
+        print(f"{name}: {size / 1024**2:.1f} MB image, {len(body) / 1024**2:.1f} MB response")
+        for label, function in (("json + b64decode", old), ("streaming parser", new)):
+            decoded, peak, blocked = measure(function, body)
+            assert decoded == image
+            print(f"  {label:<18} peak memory: {peak / 1024**2:6.1f} MB   longest loop block: {blocked * 1e3:6.2f} ms")
+
+
+if __name__ == "__main__":
+    main()